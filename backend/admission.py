@@ -0,0 +1,52 @@
+import asyncio
+
+
+class AdmissionController:
+    """
+    Concurrency limiter whose limit can be changed while work is in flight.
+
+    Used like asyncio.Semaphore (`async with controller:`), but backed by a
+    condition variable over an explicit counter so that `set_limit` can raise
+    or lower the limit safely at any time.
+    """
+
+    def __init__(self, initial: int):
+        self._cond = asyncio.Condition(asyncio.Lock())
+        self._active = 0
+        self._limit = max(1, initial)
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    async def acquire(self):
+        """Wait until a slot is free under the current limit and take it"""
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self._limit)
+            self._active += 1
+
+    async def release(self):
+        """Free a slot and wake one waiter"""
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify(1)
+
+    async def set_limit(self, limit: int):
+        """
+        Change the limit. Raising it admits waiters immediately; lowering it
+        lets in-flight work finish and only holds back new admissions.
+        """
+        async with self._cond:
+            self._limit = max(1, limit)
+            self._cond.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Iterator
+
+# Bytes read from each file per step, and roughly the size of each yielded piece
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkBuffer:
+    """Write-only, unseekable file object that collects what ZipFile writes until it is taken"""
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def iter_zip(directory: Path) -> Iterator[bytes]:
+    """
+    Zip every file under a directory, yielding the archive piece by piece as it is compressed.
+    Nothing is written to disk and memory stays around CHUNK_SIZE regardless of archive size.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for path in sorted(directory.rglob("*")):
+            if not path.is_file():
+                continue
+
+            info = zipfile.ZipInfo.from_file(path, path.relative_to(directory))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with path.open("rb") as src, archive.open(info, "w") as dst:
+                while chunk := src.read(CHUNK_SIZE):
+                    dst.write(chunk)
+                    if buffer.size >= CHUNK_SIZE:
+                        yield buffer.take()
+
+    # Remaining file data plus the central directory, written when the archive closes
+    yield buffer.take()
+
+
+def is_up_to_date(zip_path: Path, directory: Path) -> bool:
+    """Whether zip_path exists and is no older than anything under directory"""
+    try:
+        zip_mtime = zip_path.stat().st_mtime
+    except FileNotFoundError:
+        return False
+    # Directories count too, so removed files also make the zip stale
+    newest = max((p.stat().st_mtime for p in directory.rglob("*")), default=0.0)
+    return zip_mtime >= max(newest, directory.stat().st_mtime)
+
+
+def iter_zip_saved(directory: Path, zip_path: Path) -> Iterator[bytes]:
+    """
+    Stream a directory as a zip like iter_zip while also writing it to zip_path for reuse.
+    The copy is written under a temporary name and only moved into place once complete.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=zip_path.parent, prefix=f".{zip_path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as copy:
+            for chunk in iter_zip(directory):
+                copy.write(chunk)
+                yield chunk
+        os.replace(tmp_name, zip_path)
+    except BaseException:
+        # Includes GeneratorExit when the client disconnects mid-download
+        os.unlink(tmp_name)
+        raise
@@ -1,16 +1,51 @@
 import asyncio
+import hashlib
 import logging
-from typing import Dict, List
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, List, Optional
 from pathlib import Path
-import json
 
+from admission import AdmissionController
 from proxmox_client import ProxmoxClient
-from claude_analyzer import ClaudeAnalyzer
+from claude_analyzer import ClaudeAnalyzer, config_json, enabled_sections, format_context, is_error
 from database import Database
 from config import settings
+from serialization import dumps
 
 logger = logging.getLogger(__name__)
 
+# Longest a completed result waits before the writer saves it
+WRITE_FLUSH_INTERVAL = 0.5
+
+# Set while the current task holds an admission slot, so analyzer backoffs know they can give it up
+_holds_slot: ContextVar[bool] = ContextVar("holds_admission_slot", default=False)
+
+
+def _write_utf8(path: Path, content: str):
+    """Write text as UTF-8 bytes in a single call"""
+    path.write_bytes(content.encode("utf-8"))
+
+
+async def _make_dirs(dirs):
+    """Create all directories up front, in parallel and off the event loop"""
+    await asyncio.gather(*(asyncio.to_thread(d.mkdir, parents=True, exist_ok=True) for d in dirs))
+
+
+def _section_flags() -> Dict[str, bool]:
+    """Optional analysis sections enabled in settings"""
+    return {
+        "security_review": settings.enable_security_review,
+        "optimization_recommendations": settings.enable_optimization,
+        "terraform_template": settings.enable_terraform,
+        "ansible_playbook": settings.enable_ansible
+    }
+
+
+def _cache_key(vm_data: Dict) -> str:
+    """Canonical hash of every VM/LXC field that goes into its prompts"""
+    fields = {key: vm_data.get(key) for key in ("vm_id", "vm_type", "vm_name", "node", "status", "config")}
+    return hashlib.blake2b(dumps(fields, sort_keys=True).encode()).hexdigest()
+
 
 class BatchProcessor:
     def __init__(self, proxmox_client: ProxmoxClient, claude_analyzer: ClaudeAnalyzer, database: Database):
@@ -19,37 +54,129 @@ class BatchProcessor:
         self.db = database
         self.output_dir = Path(settings.output_dir)
         self.output_dir.mkdir(exist_ok=True)
-
-    async def process_single_vm(self, vm_data: Dict, cluster_context: Dict = None) -> Dict:
-        """Process a single VM/LXC with complete analysis"""
-        logger.info(f"Processing {vm_data['vm_type']} {vm_data['vm_name']} (ID: {vm_data['vm_id']})")
-
+        # Caps in-flight VM analyses across the whole job; halved while rate limited
+        self._admission = AdmissionController(settings.max_concurrency)
+        self._target_limit = settings.max_concurrency
+        self._restore_task = None
+        # The analyzer retries rate-limited calls itself; admission is throttled meanwhile
+        self.claude.on_rate_limit = self._throttle
+        self.claude.backoff_sleep = self._backoff_sleep
+        # Awaited with the job ID whenever a job's saved progress changes
+        self.on_progress: Optional[Callable[[int], Awaitable[None]]] = None
+
+    @property
+    def concurrency(self) -> Dict:
+        """Current admission state"""
+        return {
+            "limit": self._admission.limit,
+            "target": self._target_limit,
+            "active": self._admission.active
+        }
+
+    async def set_concurrency(self, limit: int):
+        """Change the concurrency limit for running and future jobs"""
+        self._target_limit = max(1, limit)
+        if self._restore_task:
+            self._restore_task.cancel()
+            self._restore_task = None
+        await self._admission.set_limit(self._target_limit)
+        logger.info(f"Concurrency limit set to {self._target_limit}")
+
+    async def _throttle(self, retry_after: float):
+        """
+        Halve the concurrency limit, restoring it once the rate limit window has passed.
+        Requests rate limited together only halve it once; later ones just extend the window.
+        """
+        already_throttled = self._restore_task is not None
+        if already_throttled:
+            self._restore_task.cancel()
+        self._restore_task = asyncio.create_task(self._restore_limit(retry_after))
+
+        if not already_throttled:
+            await self._admission.set_limit(max(1, self._target_limit // 2))
+            logger.warning(f"Rate limited; concurrency reduced to {self._admission.limit} for {retry_after:.0f}s")
+
+    async def _backoff_sleep(self, delay: float):
+        """Wait out an analyzer retry backoff, giving up the caller's admission slot meanwhile"""
+        if not _holds_slot.get():
+            await asyncio.sleep(delay)
+            return
+
+        await self._admission.release()
         try:
-            analysis_results = await self.claude.analyze_complete(
-                vm_data=vm_data,
-                cluster_context=cluster_context,
-                include_security=settings.enable_security_review,
-                include_optimization=settings.enable_optimization,
-                include_terraform=settings.enable_terraform,
-                include_ansible=settings.enable_ansible
-            )
-
-            # Merge results with VM data
-            result = {**vm_data, **analysis_results}
+            await asyncio.sleep(delay)
+        finally:
+            await self._admission.acquire()
+
+    async def _restore_limit(self, delay: float):
+        await asyncio.sleep(delay)
+        await self._admission.set_limit(self._target_limit)
+        self._restore_task = None
+        logger.info(f"Concurrency limit restored to {self._target_limit}")
 
+    async def process_single_vm(self, vm_data: Dict, cluster_json: str = None) -> Dict:
+        """Process a single VM/LXC with complete analysis"""
+        # Serialized once here instead of in every prompt and output file
+        vm_data["_config_json"] = config_json(vm_data)
+
+        async with self._admission:
+            logger.info(f"Processing {vm_data['vm_type']} {vm_data['vm_name']} (ID: {vm_data['vm_id']})")
+
+            holds_slot = _holds_slot.set(True)
+            try:
+                analysis_results = await self.claude.analyze_complete(
+                    vm_data=vm_data,
+                    cluster_json=cluster_json,
+                    include_security=settings.enable_security_review,
+                    include_optimization=settings.enable_optimization,
+                    include_terraform=settings.enable_terraform,
+                    include_ansible=settings.enable_ansible
+                )
+
+                # Merge results with VM data
+                result = {**vm_data, **analysis_results}
+
+                return result
+
+            except Exception as e:
+                logger.error(f"Error processing VM {vm_data['vm_id']}: {e}")
+                return {
+                    **vm_data,
+                    "analysis": f"Error: {str(e)}",
+                    "error": True
+                }
+            finally:
+                _holds_slot.reset(holds_slot)
+
+    async def process_batch(self, vms: List[Dict], cluster_json: str = None,
+                            completed: Optional[asyncio.Queue] = None) -> List[Dict]:
+        """
+        Process a batch of VMs/LXCs concurrently.
+        Each result is also put on `completed` (if given) as soon as it is ready.
+        VMs/LXCs unchanged since an earlier run reuse its cached analysis.
+        """
+        cached, vms = await self._split_cached(vms)
+        if completed is not None:
+            for result in cached:
+                completed.put_nowait(result)
+        if not vms:
+            return cached
+
+        if settings.use_batch_api:
+            results = await self.process_message_batch(vms, cluster_json)
+            if completed is not None:
+                for result in results:
+                    completed.put_nowait(result)
+            await self._cache_results(results)
+            return cached + results
+
+        async def process(vm: Dict) -> Dict:
+            result = await self.process_single_vm(vm, cluster_json)
+            if completed is not None:
+                completed.put_nowait(result)
             return result
 
-        except Exception as e:
-            logger.error(f"Error processing VM {vm_data['vm_id']}: {e}")
-            return {
-                **vm_data,
-                "analysis": f"Error: {str(e)}",
-                "error": True
-            }
-
-    async def process_batch(self, vms: List[Dict], cluster_context: Dict = None) -> List[Dict]:
-        """Process a batch of VMs/LXCs concurrently"""
-        tasks = [self.process_single_vm(vm, cluster_context) for vm in vms]
+        tasks = [process(vm) for vm in vms]
         results = await asyncio.gather(*tasks, return_exceptions=True)
 
         processed_results = []
@@ -59,21 +186,116 @@ class BatchProcessor:
             else:
                 processed_results.append(result)
 
-        return processed_results
+        await self._cache_results(processed_results)
+        return cached + processed_results
+
+    async def _split_cached(self, vms: List[Dict]):
+        """Split VMs/LXCs into results served from the analysis cache and ones still to analyze"""
+        if settings.force_reanalyze:
+            return [], vms
+
+        sections = enabled_sections(_section_flags())
+        for vm in vms:
+            vm["_cache_key"] = _cache_key(vm)
+        entries = await self.db.get_cached_analyses([vm["_cache_key"] for vm in vms], self.claude.version)
+
+        cached, remaining = [], []
+        for vm in vms:
+            entry = entries.get(vm["_cache_key"])
+            # An entry made with fewer sections enabled can't stand in for a fuller run
+            if entry and all(entry[section] for section in sections):
+                cached.append({**vm, **{section: entry[section] for section in sections}})
+            else:
+                remaining.append(vm)
+
+        if cached:
+            logger.info(f"Reusing cached analysis for {len(cached)} of {len(vms)} resources")
+        return cached, remaining
+
+    async def _cache_results(self, results: List[Dict]):
+        """Remember successful analyses so unchanged VMs/LXCs can skip Claude next run"""
+        sections = enabled_sections(_section_flags())
+        successful = {
+            result.get("_cache_key") or _cache_key(result): result
+            for result in results
+            if not result.get("error") and not any(is_error(section, result.get(section)) for section in sections)
+        }
+        try:
+            await self.db.save_cached_analyses(self.claude.version, successful)
+        except Exception as e:
+            # The cache is an optimization; failing to fill it must not fail the job
+            logger.warning(f"Could not update analysis cache: {e}")
 
-    async def run_full_analysis(self) -> int:
+    async def process_message_batch(self, vms: List[Dict], cluster_json: str = None) -> List[Dict]:
+        """Process VMs/LXCs as a single Message Batches submission"""
+        logger.info(f"Submitting {len(vms)} resources to the Message Batches API")
+        for vm in vms:
+            vm["_config_json"] = config_json(vm)
+
+        analyses = await self.claude.submit_batch(vms, cluster_json=cluster_json, flags=_section_flags())
+
+        return [{**vm, **analyses.get(vm["vm_id"], {})} for vm in vms]
+
+    async def _write_results(self, job_id: int, write_q: asyncio.Queue, progress: Dict, total: int):
+        """
+        Single database writer for a job. Saves completed results in bulk, flushing
+        every `batch_size` results or WRITE_FLUSH_INTERVAL seconds, until it receives None.
+        """
+        loop = asyncio.get_running_loop()
+        pending = []
+        flush_at = None
+        finished = False
+
+        while not finished:
+            timeout = None if flush_at is None else max(0.0, flush_at - loop.time())
+            try:
+                result = await asyncio.wait_for(write_q.get(), timeout)
+                if result is None:
+                    finished = True
+                else:
+                    pending.append(result)
+                    flush_at = flush_at or loop.time() + WRITE_FLUSH_INTERVAL
+            except asyncio.TimeoutError:
+                pass
+
+            if pending and (finished or len(pending) >= settings.batch_size or loop.time() >= flush_at):
+                await self.db.save_vm_analyses_bulk(job_id, pending)
+                progress["processed"] += len(pending)
+                pending = []
+                flush_at = None
+
+                await self.db.update_batch_job(job_id, progress["processed"])
+                logger.info(f"Completed {progress['processed']}/{total} resources")
+                await self._notify_progress(job_id)
+
+    async def _notify_progress(self, job_id: int):
+        """Report a progress change to on_progress without letting it disrupt the job"""
+        if self.on_progress is None:
+            return
+        try:
+            await self.on_progress(job_id)
+        except Exception as e:
+            logger.warning(f"Progress notification for job {job_id} failed: {e}")
+
+    async def run_full_analysis(self, job_id: Optional[int] = None,
+                                resources: Optional[List[Dict]] = None) -> int:
         """
         Run complete analysis of entire Proxmox infrastructure
+        Runs as the existing batch job `job_id` if given, otherwise creates one
+        `resources` skips refetching VMs/LXCs the caller already has
         Returns the batch job ID
         """
         logger.info("Starting full infrastructure analysis")
 
         # Get cluster information
-        cluster_info = self.proxmox.get_cluster_info()
+        cluster_info = await self.proxmox.get_cluster_info()
         logger.info(f"Cluster has {len(cluster_info.get('nodes', []))} nodes")
 
+        # Render cluster context once so every request shares an identical cacheable prefix
+        cluster_json = format_context(cluster_info)
+
         # Get all VMs and LXCs
-        all_resources = self.proxmox.get_all_resources()
+        all_resources = resources if resources is not None else await self.proxmox.get_all_resources()
         logger.info(f"Found {len(all_resources)} total resources to analyze")
 
         if not all_resources:
@@ -81,34 +303,23 @@ class BatchProcessor:
             return None
 
         # Create batch job in database
-        job_id = await self.db.create_batch_job(len(all_resources))
-        logger.info(f"Created batch job {job_id}")
+        if job_id is None:
+            job_id = await self.db.create_batch_job(len(all_resources))
+            logger.info(f"Created batch job {job_id}")
 
         # Create job-specific output directory
         job_output_dir = self.output_dir / f"job_{job_id}"
         job_output_dir.mkdir(exist_ok=True)
 
-        try:
-            # Process resources in batches
-            batch_size = settings.batch_size
-            all_results = []
-            processed_count = 0
-
-            for i in range(0, len(all_resources), batch_size):
-                batch = all_resources[i:i + batch_size]
-                logger.info(f"Processing batch {i // batch_size + 1} ({len(batch)} resources)")
-
-                batch_results = await self.process_batch(batch, cluster_info)
-                all_results.extend(batch_results)
+        # Results are saved and progress reported by a single writer task as they complete
+        progress = {"processed": 0}
+        write_q = asyncio.Queue()
+        writer = asyncio.create_task(self._write_results(job_id, write_q, progress, len(all_resources)))
 
-                # Save each VM analysis to database
-                for result in batch_results:
-                    await self.db.save_vm_analysis(job_id, result)
-
-                processed_count += len(batch_results)
-                await self.db.update_batch_job(job_id, processed_count)
-
-                logger.info(f"Completed {processed_count}/{len(all_resources)} resources")
+        try:
+            all_results = await self.process_batch(all_resources, cluster_json, write_q)
+            await write_q.put(None)
+            await writer
 
             # Generate individual files for each VM/LXC
             await self.save_individual_outputs(job_id, all_results, job_output_dir)
@@ -120,66 +331,82 @@ class BatchProcessor:
 
             # Save summary to file
             summary_file = job_output_dir / "infrastructure_summary.md"
-            summary_file.write_text(summary)
+            await asyncio.to_thread(_write_utf8, summary_file, summary)
 
             # Generate consolidated outputs
             await self.generate_consolidated_outputs(job_id, all_results, job_output_dir)
 
             # Mark job as completed
-            await self.db.update_batch_job(job_id, processed_count, status="completed")
+            await self.db.update_batch_job(job_id, progress["processed"], status="completed")
             logger.info(f"Batch job {job_id} completed successfully")
 
             return job_id
 
         except Exception as e:
             logger.error(f"Error during batch processing: {e}")
-            await self.db.update_batch_job(job_id, processed_count, status="failed", error=str(e))
+            writer.cancel()
+            await self.db.update_batch_job(job_id, progress["processed"], status="failed", error=str(e))
             raise
 
     async def save_individual_outputs(self, job_id: int, results: List[Dict], output_dir: Path):
         """Save individual files for each VM/LXC"""
         logger.info("Saving individual VM/LXC outputs")
+        writes = []
 
+        vm_dirs = []
         for result in results:
             vm_name = result['vm_name'].replace(' ', '_').replace('/', '_')
-            vm_dir = output_dir / f"{result['vm_type']}_{vm_name}_{result['vm_id']}"
-            vm_dir.mkdir(exist_ok=True)
+            vm_dirs.append(output_dir / f"{result['vm_type']}_{vm_name}_{result['vm_id']}")
+        await _make_dirs(set(vm_dirs))
 
+        for result, vm_dir in zip(results, vm_dirs):
             # Save analysis
             if result.get('analysis'):
-                (vm_dir / "analysis.md").write_text(result['analysis'])
+                writes.append(asyncio.to_thread(_write_utf8, vm_dir / "analysis.md", result['analysis']))
 
             # Save security review
             if result.get('security_review'):
-                (vm_dir / "security_review.md").write_text(result['security_review'])
+                writes.append(asyncio.to_thread(_write_utf8, vm_dir / "security_review.md", result['security_review']))
 
             # Save optimization recommendations
             if result.get('optimization_recommendations'):
-                (vm_dir / "optimization_recommendations.md").write_text(result['optimization_recommendations'])
+                writes.append(asyncio.to_thread(_write_utf8, vm_dir / "optimization_recommendations.md", result['optimization_recommendations']))
 
             # Save Terraform template
             if result.get('terraform_template'):
-                (vm_dir / "main.tf").write_text(result['terraform_template'])
+                writes.append(asyncio.to_thread(_write_utf8, vm_dir / "main.tf", result['terraform_template']))
 
             # Save Ansible playbook
             if result.get('ansible_playbook'):
-                (vm_dir / "playbook.yml").write_text(result['ansible_playbook'])
+                writes.append(asyncio.to_thread(_write_utf8, vm_dir / "playbook.yml", result['ansible_playbook']))
 
             # Save raw configuration
-            (vm_dir / "config.json").write_text(json.dumps(result['config'], indent=2))
+            writes.append(asyncio.to_thread(_write_utf8, vm_dir / "config.json", config_json(result)))
+
+        # Write files off the event loop, all at once
+        await asyncio.gather(*writes)
 
     async def generate_consolidated_outputs(self, job_id: int, results: List[Dict], output_dir: Path):
         """Generate consolidated Terraform and Ansible files"""
         logger.info("Generating consolidated IaC templates")
+        writes = []
 
-        # Consolidated Terraform
+        terraform_dir = output_dir / "terraform"
+        ansible_dir = output_dir / "ansible"
+        playbooks_dir = ansible_dir / "playbooks"
+
+        dirs = []
         if settings.enable_terraform:
-            terraform_dir = output_dir / "terraform"
-            terraform_dir.mkdir(exist_ok=True)
+            dirs.append(terraform_dir)
+        if settings.enable_ansible:
+            dirs.append(playbooks_dir)
+        await _make_dirs(dirs)
 
-            # Main file with all resources
-            main_tf_content = "# Proxmox Infrastructure - Generated by Proxmox Batch Processor\n\n"
-            main_tf_content += """terraform {
+        # Consolidated Terraform
+        if settings.enable_terraform:
+            # Main file with all resources, assembled from parts to avoid re-copying on every append
+            main_tf_parts = ["# Proxmox Infrastructure - Generated by Proxmox Batch Processor\n\n"]
+            main_tf_parts.append("""terraform {
   required_providers {
     proxmox = {
       source  = "Telmate/proxmox"
@@ -195,14 +422,15 @@ provider "proxmox" {
   pm_tls_insecure = true
 }
 
-"""
+""")
 
             for result in results:
                 if result.get('terraform_template'):
-                    main_tf_content += f"\n# {result['vm_name']} ({result['vm_id']})\n"
-                    main_tf_content += result['terraform_template'] + "\n\n"
+                    main_tf_parts.append(f"\n# {result['vm_name']} ({result['vm_id']})\n")
+                    main_tf_parts.append(result['terraform_template'])
+                    main_tf_parts.append("\n\n")
 
-            (terraform_dir / "main.tf").write_text(main_tf_content)
+            writes.append(asyncio.to_thread(_write_utf8, terraform_dir / "main.tf", "".join(main_tf_parts)))
 
             # Variables file
             variables_tf = """variable "proxmox_api_url" {
@@ -221,7 +449,7 @@ variable "proxmox_api_token_secret" {
   sensitive   = true
 }
 """
-            (terraform_dir / "variables.tf").write_text(variables_tf)
+            writes.append(asyncio.to_thread(_write_utf8, terraform_dir / "variables.tf", variables_tf))
 
             # README
             readme = """# Proxmox Infrastructure - Terraform
@@ -252,40 +480,36 @@ Set the following variables in `terraform.tfvars` or via environment variables:
 - `proxmox_api_token_id`
 - `proxmox_api_token_secret`
 """
-            (terraform_dir / "README.md").write_text(readme)
+            writes.append(asyncio.to_thread(_write_utf8, terraform_dir / "README.md", readme))
 
         # Consolidated Ansible
         if settings.enable_ansible:
-            ansible_dir = output_dir / "ansible"
-            ansible_dir.mkdir(exist_ok=True)
 
             # Main playbook
-            playbook_content = """---
+            playbook_parts = ["""---
 # Proxmox Infrastructure - Generated by Proxmox Batch Processor
 - name: Provision Proxmox Infrastructure
   hosts: localhost
   gather_facts: false
   tasks:
 
-"""
+"""]
 
             for i, result in enumerate(results):
                 if result.get('ansible_playbook'):
-                    playbook_content += f"    # {result['vm_name']} ({result['vm_id']})\n"
+                    playbook_parts.append(f"    # {result['vm_name']} ({result['vm_id']})\n")
                     # Extract tasks from the generated playbook (simplified)
-                    playbook_content += f"    # See individual playbooks for details\n\n"
+                    playbook_parts.append("    # See individual playbooks for details\n\n")
 
-            (ansible_dir / "site.yml").write_text(playbook_content)
+            writes.append(asyncio.to_thread(_write_utf8, ansible_dir / "site.yml", "".join(playbook_parts)))
 
             # Save individual playbooks
-            playbooks_dir = ansible_dir / "playbooks"
-            playbooks_dir.mkdir(exist_ok=True)
 
             for result in results:
                 if result.get('ansible_playbook'):
                     vm_name = result['vm_name'].replace(' ', '_').replace('/', '_')
                     playbook_file = playbooks_dir / f"{vm_name}_{result['vm_id']}.yml"
-                    playbook_file.write_text(result['ansible_playbook'])
+                    writes.append(asyncio.to_thread(_write_utf8, playbook_file, result['ansible_playbook']))
 
             # README
             readme = """# Proxmox Infrastructure - Ansible
@@ -311,6 +535,7 @@ This directory contains generated Ansible playbooks for your Proxmox infrastruct
 - `playbooks/`: Individual playbooks for each VM/LXC
 - `site.yml`: Main playbook (customize as needed)
 """
-            (ansible_dir / "README.md").write_text(readme)
+            writes.append(asyncio.to_thread(_write_utf8, ansible_dir / "README.md", readme))
 
+        await asyncio.gather(*writes)
         logger.info("Consolidated outputs generated successfully")
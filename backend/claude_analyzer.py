@@ -1,41 +1,76 @@
-from anthropic import Anthropic
-import json
-from typing import Dict, Optional
+from anthropic import (
+    APIConnectionError, APIStatusError, AsyncAnthropic, DefaultAsyncHttpxClient, InternalServerError,
+    RateLimitError
+)
+import asyncio
+import httpx
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 import logging
 
-logger = logging.getLogger(__name__)
-
-
-class ClaudeAnalyzer:
-    def __init__(self, api_key: str, model: str = "claude-sonnet-4-20250514", max_tokens: int = 8000):
-        """Initialize Claude API client"""
-        self.client = Anthropic(api_key=api_key)
-        self.model = model
-        self.max_tokens = max_tokens
-
-    async def analyze_vm(self, vm_data: Dict, cluster_context: Optional[Dict] = None) -> Dict:
-        """
-        Analyze a single VM/LXC and generate comprehensive documentation and templates
-        """
-        vm_config = json.dumps(vm_data["config"], indent=2)
-        context = json.dumps(cluster_context, indent=2) if cluster_context else "No cluster context provided"
-
-        prompt = f"""You are analyzing a Proxmox virtual machine/container as part of a comprehensive infrastructure audit.
+from tenacity import (
+    AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+)
 
-VM/LXC Details:
-- ID: {vm_data["vm_id"]}
-- Name: {vm_data["vm_name"]}
-- Type: {vm_data["vm_type"]}
-- Node: {vm_data["node"]}
-- Status: {vm_data["status"]}
+from serialization import dumps
 
-Configuration:
-{vm_config}
-
-Cluster Context:
-{context}
+logger = logging.getLogger(__name__)
 
-Please provide a comprehensive analysis including:
+# Per-VM analysis sections, in the order they are produced
+SECTIONS = (
+    "analysis",
+    "security_review",
+    "optimization_recommendations",
+    "terraform_template",
+    "ansible_playbook",
+)
+
+# Fallback content stored for a section when its generation fails
+ERROR_MESSAGES = {
+    "analysis": "Error during analysis: {}",
+    "security_review": "Error during security review: {}",
+    "optimization_recommendations": "Error generating optimizations: {}",
+    "terraform_template": "# Error generating Terraform: {}",
+    "ansible_playbook": "# Error generating Ansible: {}",
+}
+
+# Bump whenever prompts change in a way that should invalidate cached analyses
+ANALYZER_VERSION = "2"
+
+# Message Batches API limits on one batch: 100,000 requests or 256 MB, whichever comes first
+MAX_BATCH_REQUESTS = 100_000
+# Kept under the 256 MB cap to leave room for the request envelope
+MAX_BATCH_BYTES = 250 * 1000 * 1000
+
+# Guests listed in the cluster context inventory; larger clusters are truncated
+MAX_CONTEXT_GUESTS = 1000
+
+# Output token caps per section, sized to what each section needs
+SECTION_MAX_TOKENS = {
+    "analysis": 1500,
+    "security_review": 2500,
+    "optimization_recommendations": 2500,
+    "terraform_template": 4000,
+    "ansible_playbook": 4000,
+}
+
+# Transient API failures worth retrying; other 4xx errors would fail the same way again
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+# Error types that can arrive as an event partway through a stream
+RETRYABLE_STREAM_ERRORS = ("overloaded_error", "api_error")
+MAX_ATTEMPTS = 5
+
+# Seconds to back off when a rate limit response has no usable retry-after header
+DEFAULT_RETRY_AFTER = 30.0
+
+# Role framing shared by every per-VM request; kept byte-identical so it can be prompt-cached
+STATIC_ROLE_PROMPT = """You are analyzing Proxmox virtual machines and LXC containers as part of a comprehensive infrastructure audit.
+
+Each request describes a single VM/LXC (its details and configuration) and asks for one or more of the deliverables below about it. Use the cluster context below to understand where the resource fits in the wider infrastructure."""
+
+
+# Task instructions for each section, shared by the per-section and one-shot prompts
+ANALYSIS_TASK = """Please provide a comprehensive analysis including:
 
 1. **Purpose and Role**: What this VM/LXC appears to be used for
 2. **Resource Allocation**: CPU, memory, disk, network configuration assessment
@@ -45,30 +80,7 @@ Please provide a comprehensive analysis including:
 
 Keep this analysis concise but thorough (2-3 paragraphs)."""
 
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return {"analysis": response.content[0].text}
-        except Exception as e:
-            logger.error(f"Error analyzing VM {vm_data['vm_id']}: {e}")
-            return {"analysis": f"Error during analysis: {str(e)}"}
-
-    async def security_review(self, vm_data: Dict) -> Dict:
-        """Generate security review for a VM/LXC"""
-        vm_config = json.dumps(vm_data["config"], indent=2)
-
-        prompt = f"""Perform a security review of this Proxmox VM/LXC configuration:
-
-Type: {vm_data["vm_type"]}
-Name: {vm_data["vm_name"]}
-
-Configuration:
-{vm_config}
-
-Provide a security assessment covering:
+SECURITY_TASK = """Provide a security assessment covering:
 
 1. **Network Security**: Firewall settings, network isolation, exposed services
 2. **Resource Limits**: CPU/memory limits for DoS prevention
@@ -78,31 +90,7 @@ Provide a security assessment covering:
 
 Format as a structured report with clear action items."""
 
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return {"security_review": response.content[0].text}
-        except Exception as e:
-            logger.error(f"Error in security review for {vm_data['vm_id']}: {e}")
-            return {"security_review": f"Error during security review: {str(e)}"}
-
-    async def optimization_recommendations(self, vm_data: Dict) -> Dict:
-        """Generate optimization recommendations"""
-        vm_config = json.dumps(vm_data["config"], indent=2)
-
-        prompt = f"""Analyze this Proxmox VM/LXC for optimization opportunities:
-
-Type: {vm_data["vm_type"]}
-Name: {vm_data["vm_name"]}
-Status: {vm_data["status"]}
-
-Configuration:
-{vm_config}
-
-Provide optimization recommendations for:
+OPTIMIZATION_TASK = """Provide optimization recommendations for:
 
 1. **Resource Optimization**: CPU, memory, and disk allocation improvements
 2. **Performance**: Configuration changes for better performance
@@ -112,31 +100,7 @@ Provide optimization recommendations for:
 
 Provide concrete, actionable recommendations with expected benefits."""
 
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return {"optimization_recommendations": response.content[0].text}
-        except Exception as e:
-            logger.error(f"Error generating optimizations for {vm_data['vm_id']}: {e}")
-            return {"optimization_recommendations": f"Error generating optimizations: {str(e)}"}
-
-    async def generate_terraform(self, vm_data: Dict) -> Dict:
-        """Generate Terraform template for VM/LXC"""
-        vm_config = json.dumps(vm_data["config"], indent=2)
-
-        prompt = f"""Generate a Terraform template using the Telmate/proxmox provider to recreate this VM/LXC:
-
-Type: {vm_data["vm_type"]}
-Name: {vm_data["vm_name"]}
-Node: {vm_data["node"]}
-
-Current Configuration:
-{vm_config}
-
-Generate:
+TERRAFORM_TASK = """Generate:
 1. A complete Terraform resource definition
 2. Variable definitions for configurable parameters
 3. Output values for important attributes
@@ -148,65 +112,120 @@ Use the appropriate resource type:
 
 Make the template reusable and follow Terraform best practices."""
 
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return {"terraform_template": response.content[0].text}
-        except Exception as e:
-            logger.error(f"Error generating Terraform for {vm_data['vm_id']}: {e}")
-            return {"terraform_template": f"# Error generating Terraform: {str(e)}"}
+ANSIBLE_TASK = """Generate:
+1. Ansible playbook for creating/configuring the VM/LXC
+2. Variable definitions
+3. Tasks for common setup based on the configuration
+4. Handlers if needed
 
-    async def generate_ansible(self, vm_data: Dict) -> Dict:
-        """Generate Ansible playbook for VM/LXC"""
-        vm_config = json.dumps(vm_data["config"], indent=2)
+Use the community.general.proxmox module for QEMU VMs or community.general.proxmox_lxc for containers.
+Include basic post-creation configuration tasks where applicable."""
+
+SECTION_HEADINGS = {
+    "analysis": "Analyze the purpose and configuration of this Proxmox VM/LXC",
+    "security_review": "Perform a security review of this Proxmox VM/LXC configuration",
+    "optimization_recommendations": "Analyze this Proxmox VM/LXC for optimization opportunities",
+    "terraform_template": "Generate a Terraform template using the Telmate/proxmox provider to recreate this VM/LXC",
+    "ansible_playbook": "Generate an Ansible playbook to provision and configure this VM/LXC",
+}
+
+SECTION_TASKS = {
+    "analysis": ANALYSIS_TASK,
+    "security_review": SECURITY_TASK,
+    "optimization_recommendations": OPTIMIZATION_TASK,
+    "terraform_template": TERRAFORM_TASK,
+    "ansible_playbook": ANSIBLE_TASK,
+}
+
+# Instructions for every deliverable live in the system prompt, ahead of anything per-VM,
+# so they are part of the cached prefix rather than repeated in each user message
+SYSTEM_PROMPT = STATIC_ROLE_PROMPT + "\n\nDeliverables:\n\n" + "\n\n".join(
+    f"<{section}>: {SECTION_HEADINGS[section]}\n\n{SECTION_TASKS[section]}"
+    for section in SECTIONS
+)
+
+# Closing line of each per-section prompt, pointing at that section's instructions
+SECTION_REQUESTS = {
+    section: f"Write the <{section}> deliverable for this VM/LXC following its instructions. "
+             f"Reply with the deliverable itself, without the <{section}> tags."
+    for section in SECTIONS
+}
+
+# Matches an opening <section> tag in one-shot output
+SECTION_OPEN_RE = re.compile(r"<(\w+)>")
+
+
+# Prompt templates, assembled once at import. Section headings and task text are
+# baked in as literals, so they must not contain "{" or "}".
+VM_DETAILS_TMPL = """VM/LXC Details:
+- ID: {vm_id}
+- Name: {vm_name}
+- Type: {vm_type}
+- Node: {node}
+- Status: {status}
+
+Configuration:
+{vm_config}"""
 
-        prompt = f"""Generate an Ansible playbook to provision and configure this VM/LXC:
+ANALYZE_TMPL = VM_DETAILS_TMPL + "\n\n" + SECTION_REQUESTS["analysis"]
 
-Type: {vm_data["vm_type"]}
-Name: {vm_data["vm_name"]}
+SECURITY_TMPL = SECTION_HEADINGS["security_review"] + """:
+
+Type: {vm_type}
+Name: {vm_name}
 
 Configuration:
 {vm_config}
 
-Generate:
-1. Ansible playbook for creating/configuring the VM/LXC
-2. Variable definitions
-3. Tasks for common setup based on the configuration
-4. Handlers if needed
+""" + SECTION_REQUESTS["security_review"]
 
-Use the community.general.proxmox module for QEMU VMs or community.general.proxmox_lxc for containers.
-Include basic post-creation configuration tasks where applicable."""
+OPTIMIZATION_TMPL = SECTION_HEADINGS["optimization_recommendations"] + """:
 
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return {"ansible_playbook": response.content[0].text}
-        except Exception as e:
-            logger.error(f"Error generating Ansible for {vm_data['vm_id']}: {e}")
-            return {"ansible_playbook": f"# Error generating Ansible: {str(e)}"}
+Type: {vm_type}
+Name: {vm_name}
+Status: {status}
 
-    async def generate_infrastructure_summary(self, all_analyses: list, cluster_info: Dict) -> str:
-        """Generate comprehensive infrastructure summary report"""
-        summary_data = {
-            "total_resources": len(all_analyses),
-            "vms": len([a for a in all_analyses if a.get("vm_type") == "qemu"]),
-            "lxcs": len([a for a in all_analyses if a.get("vm_type") == "lxc"]),
-            "nodes": cluster_info.get("nodes", [])
-        }
+Configuration:
+{vm_config}
+
+""" + SECTION_REQUESTS["optimization_recommendations"]
+
+TERRAFORM_TMPL = SECTION_HEADINGS["terraform_template"] + """:
+
+Type: {vm_type}
+Name: {vm_name}
+Node: {node}
+
+Current Configuration:
+{vm_config}
+
+""" + SECTION_REQUESTS["terraform_template"]
+
+ANSIBLE_TMPL = SECTION_HEADINGS["ansible_playbook"] + """:
+
+Type: {vm_type}
+Name: {vm_name}
 
-        prompt = f"""Generate a comprehensive infrastructure summary report for a Proxmox cluster.
+Configuration:
+{vm_config}
+
+""" + SECTION_REQUESTS["ansible_playbook"]
+
+ONE_SHOT_TMPL = VM_DETAILS_TMPL + """
+
+Produce each of the following deliverables for this VM/LXC, following their instructions.
+
+{tasks}
+
+Produce output with these exact XML tags in order: {tags}. Wrap each deliverable in its own opening and closing tag and write nothing outside the tags."""
+
+SUMMARY_TMPL = """Generate a comprehensive infrastructure summary report for a Proxmox cluster.
 
 Cluster Overview:
-- Total VMs/LXCs: {summary_data['total_resources']}
-- QEMU VMs: {summary_data['vms']}
-- LXC Containers: {summary_data['lxcs']}
-- Nodes: {', '.join(summary_data['nodes'])}
+- Total VMs/LXCs: {total_resources}
+- QEMU VMs: {vms}
+- LXC Containers: {lxcs}
+- Nodes: {nodes}
 
 Create an executive summary covering:
 
@@ -219,44 +238,648 @@ Create an executive summary covering:
 
 This is for a comprehensive infrastructure audit. Be thorough but concise."""
 
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                messages=[{"role": "user", "content": prompt}]
+
+def _fill(template: str, vm_data: Dict, vm_config: str) -> str:
+    """Fill a per-VM prompt template; templates use only the fields they need"""
+    return template.format(
+        vm_id=vm_data["vm_id"],
+        vm_name=vm_data["vm_name"],
+        vm_type=vm_data["vm_type"],
+        node=vm_data["node"],
+        status=vm_data["status"],
+        vm_config=vm_config
+    )
+
+
+def analysis_prompt(vm_data: Dict, vm_config: str) -> str:
+    """Build the base analysis prompt for a VM/LXC"""
+    return _fill(ANALYZE_TMPL, vm_data, vm_config)
+
+
+def security_review_prompt(vm_data: Dict, vm_config: str) -> str:
+    """Build the security review prompt for a VM/LXC"""
+    return _fill(SECURITY_TMPL, vm_data, vm_config)
+
+
+def optimization_prompt(vm_data: Dict, vm_config: str) -> str:
+    """Build the optimization recommendations prompt for a VM/LXC"""
+    return _fill(OPTIMIZATION_TMPL, vm_data, vm_config)
+
+
+def terraform_prompt(vm_data: Dict, vm_config: str) -> str:
+    """Build the Terraform generation prompt for a VM/LXC"""
+    return _fill(TERRAFORM_TMPL, vm_data, vm_config)
+
+
+def ansible_prompt(vm_data: Dict, vm_config: str) -> str:
+    """Build the Ansible generation prompt for a VM/LXC"""
+    return _fill(ANSIBLE_TMPL, vm_data, vm_config)
+
+
+def one_shot_prompt(vm_data: Dict, vm_config: str, sections: List[str]) -> str:
+    """Build a single prompt requesting every enabled section for a VM/LXC"""
+    # Numbered per request since sections can be disabled
+    tasks = "\n".join(
+        f"{i}. <{section}>: {SECTION_HEADINGS[section]}"
+        for i, section in enumerate(sections, start=1)
+    )
+    tags = ", ".join(f"<{section}>" for section in sections)
+
+    return ONE_SHOT_TMPL.format(
+        vm_id=vm_data["vm_id"],
+        vm_name=vm_data["vm_name"],
+        vm_type=vm_data["vm_type"],
+        node=vm_data["node"],
+        status=vm_data["status"],
+        vm_config=vm_config,
+        tasks=tasks,
+        tags=tags
+    )
+
+
+class SectionStreamParser:
+    """
+    Incrementally splits one-shot output into its <section>...</section> parts.
+    Text is routed to its section as it arrives, so the raw response never
+    has to be assembled; a tag split across chunks is held back until complete.
+    """
+
+    def __init__(self, sections: List[str]):
+        self.sections = sections
+        self._parts = {section: [] for section in sections}
+        # Sections whose closing tag has been seen, so they are known to be complete
+        self.finished: List[str] = []
+        self._current = None
+        self._pending = ""
+        self._longest_tag = max(len(f"<{section}>") for section in sections)
+
+    def feed(self, text: str):
+        self._pending += text
+        while self._pending:
+            if self._current is None:
+                if not self._open_section():
+                    break
+            elif not self._close_section():
+                break
+
+    def _open_section(self) -> bool:
+        match = SECTION_OPEN_RE.search(self._pending)
+        while match and match.group(1) not in self._parts:
+            match = SECTION_OPEN_RE.search(self._pending, match.end())
+
+        if match:
+            self._current = match.group(1)
+            self._pending = self._pending[match.end():]
+            return True
+
+        # Text outside sections is dropped, except a possible partial opening tag
+        start = self._pending.rfind("<")
+        tail = self._pending[start:] if start != -1 else ""
+        self._pending = tail if ">" not in tail and len(tail) < self._longest_tag else ""
+        return False
+
+    def _close_section(self) -> bool:
+        closing = f"</{self._current}>"
+        end = self._pending.find(closing)
+
+        if end != -1:
+            self._parts[self._current].append(self._pending[:end])
+            self._pending = self._pending[end + len(closing):]
+            self.finished.append(self._current)
+            self._current = None
+            return True
+
+        # Route everything except a tail that could be the start of the closing tag
+        keep = len(closing) - 1
+        if len(self._pending) > keep:
+            self._parts[self._current].append(self._pending[:-keep])
+            self._pending = self._pending[-keep:]
+        return False
+
+    def close(self) -> Dict[str, str]:
+        """Finish parsing and return every section; an unterminated last section is kept as-is"""
+        if self._current is not None:
+            self._parts[self._current].append(self._pending)
+        self._current = None
+        self._pending = ""
+
+        return {
+            section: "".join(self._parts[section]).strip()
+            or ERROR_MESSAGES[section].format("section missing from response")
+            for section in self.sections
+        }
+
+
+def build_prompt(section: str, vm_data: Dict, vm_config: str) -> str:
+    """Build the prompt for one analysis section of a VM/LXC"""
+    if section == "analysis":
+        return analysis_prompt(vm_data, vm_config)
+    if section == "security_review":
+        return security_review_prompt(vm_data, vm_config)
+    if section == "optimization_recommendations":
+        return optimization_prompt(vm_data, vm_config)
+    if section == "terraform_template":
+        return terraform_prompt(vm_data, vm_config)
+    if section == "ansible_playbook":
+        return ansible_prompt(vm_data, vm_config)
+    raise ValueError(f"Unknown analysis section: {section}")
+
+
+def enabled_sections(flags: Dict[str, bool]) -> List[str]:
+    """Sections to generate given per-section flags (base analysis is always included)"""
+    return [s for s in SECTIONS if s == "analysis" or flags.get(s, False)]
+
+
+def is_error(section: str, text: Optional[str]) -> bool:
+    """Whether a section's text is missing or one of the ERROR_MESSAGES placeholders"""
+    return not text or text.startswith(ERROR_MESSAGES[section].format(""))
+
+
+def config_json(vm_data: Dict) -> str:
+    """Indented config JSON for a VM/LXC, reusing the copy precomputed by BatchProcessor if present"""
+    return vm_data.get("_config_json") or dumps(vm_data["config"], indent=True)
+
+
+def summarize_cluster(cluster_info: Dict) -> Dict:
+    """
+    Nodes, per-node guest counts and a one-line-per-guest inventory,
+    instead of the full cluster/resources dump.
+    """
+    guests, inventory = {}, []
+    for resource in cluster_info.get("resources", []):
+        vm_type = resource.get("type")
+        if vm_type not in ("qemu", "lxc"):
+            continue
+        counts = guests.setdefault(resource.get("node"), {"qemu": 0, "lxc": 0, "running": 0})
+        counts[vm_type] += 1
+        if resource.get("status") == "running":
+            counts["running"] += 1
+        inventory.append((resource.get("vmid", 0), resource.get("name") or "-", vm_type,
+                          resource.get("node"), resource.get("status")))
+
+    # Sorted so the rendered context, and with it the cached prompt prefix, is stable between jobs
+    inventory.sort(key=lambda guest: (guest[0], guest[3] or ""))
+    lines = [" ".join(str(field) for field in guest) for guest in inventory[:MAX_CONTEXT_GUESTS]]
+    if len(inventory) > MAX_CONTEXT_GUESTS:
+        lines.append(f"... {len(inventory) - MAX_CONTEXT_GUESTS} more guests not listed")
+
+    return {
+        "nodes": cluster_info.get("nodes", []),
+        "guests": guests,
+        "inventory (vmid name type node status)": lines
+    }
+
+
+def format_context(cluster_context: Optional[Dict]) -> str:
+    """Render cluster context once per job so every request shares the same cached prefix"""
+    if not cluster_context:
+        return "No cluster context provided"
+    return dumps(summarize_cluster(cluster_context), indent=True)
+
+
+def batch_chunks(requests: List[Dict]) -> List[List[Dict]]:
+    """Split batch requests into groups within both the request count and byte limits"""
+    chunks, chunk, chunk_bytes = [], [], 0
+    for request in requests:
+        size = len(dumps(request).encode())
+        if chunk and (len(chunk) >= MAX_BATCH_REQUESTS or chunk_bytes + size > MAX_BATCH_BYTES):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(request)
+        chunk_bytes += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def build_system(cluster_json: Optional[str]) -> List[Dict]:
+    """
+    System blocks for per-VM requests: the static instructions, then the job's cluster context.
+    One cache breakpoint after the context caches both for every VM in the job. The
+    instructions alone are below the model's minimum cacheable length (1024 tokens for
+    Sonnet), so a breakpoint on them would be ignored; a cluster small enough that the
+    whole prefix falls short of it is sent uncached.
+    """
+    return [
+        {"type": "text", "text": SYSTEM_PROMPT},
+        {
+            "type": "text",
+            "text": f"Cluster Context:\n{cluster_json or format_context(None)}",
+            "cache_control": {"type": "ephemeral"}
+        }
+    ]
+
+
+class TruncatedResponseError(Exception):
+    """A response stopped at its max_tokens cap, so its content is incomplete"""
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the API asked us to wait, from the retry-after header when present"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an API call that failed with this error is worth retrying"""
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # An error sent mid-stream is raised with the stream's 200 status, so only its body tells what it was
+    if isinstance(error, APIStatusError) and isinstance(error.body, dict):
+        return (error.body.get("error") or {}).get("type") in RETRYABLE_STREAM_ERRORS
+    return False
+
+
+_backoff = wait_exponential_jitter(initial=1, max=30)
+
+
+def _retry_wait(retry_state) -> float:
+    """Honor retry-after when the API sends it, otherwise back off exponentially with jitter"""
+    delay = retry_after(retry_state.outcome.exception())
+    return delay if delay is not None else _backoff(retry_state)
+
+
+class ClaudeAnalyzer:
+    def __init__(self, api_key: str, model: str = "claude-sonnet-4-20250514", max_tokens: int = 8000,
+                 batch_poll_interval: float = 5.0, batch_poll_max_interval: float = 60.0,
+                 one_shot: bool = False, max_connections: int = 64,
+                 section_max_tokens: Optional[Dict[str, int]] = None):
+        """Initialize Claude API client"""
+        # One pooled async HTTP client so concurrent calls reuse keep-alive TLS connections
+        self.client = AsyncAnthropic(
+            api_key=api_key,
+            # Retries are handled by _call so rate limits can be reported to on_rate_limit
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
             )
-            return response.content[0].text
+        )
+        self.model = model
+        # max_tokens caps the infrastructure summary; sections have their own caps
+        self.max_tokens = max_tokens
+        self.section_max_tokens = {**SECTION_MAX_TOKENS, **(section_max_tokens or {})}
+        self.one_shot = one_shot
+        self.batch_poll_interval = batch_poll_interval
+        self.batch_poll_max_interval = batch_poll_max_interval
+        # Awaited with the retry-after delay whenever a call is rate limited
+        self.on_rate_limit: Optional[Callable[[float], Awaitable[None]]] = None
+        # Waits out the backoff before each retry; callers can swap it to free resources meanwhile
+        self.backoff_sleep: Callable[[float], Awaitable[None]] = asyncio.sleep
+
+    @property
+    def version(self) -> str:
+        """Identifies the prompts and model that produced an analysis, for result caching"""
+        return f"{ANALYZER_VERSION}:{self.model}"
+
+    def _params(self, prompt: str, system: Optional[List[Dict]] = None, max_tokens: Optional[int] = None) -> Dict:
+        """Request parameters shared by direct calls and Message Batches entries"""
+        params = {
+            "model": self.model,
+            "max_tokens": max_tokens or self.max_tokens,
+            "messages": [{"role": "user", "content": prompt}]
+        }
+        if system:
+            params["system"] = system
+        return params
+
+    async def close(self):
+        """Close the underlying HTTP connection pool"""
+        await self.client.close()
+
+    async def _call(self, fn: Callable[..., Awaitable], *args, **kwargs):
+        """Await an API call, retrying transient failures with backoff"""
+        retrying = AsyncRetrying(
+            retry=retry_if_exception(is_retryable),
+            wait=_retry_wait,
+            stop=stop_after_attempt(MAX_ATTEMPTS),
+            sleep=self.backoff_sleep,
+            reraise=True
+        )
+        async for attempt in retrying:
+            with attempt:
+                try:
+                    return await fn(*args, **kwargs)
+                except RateLimitError as e:
+                    if self.on_rate_limit:
+                        await self.on_rate_limit(retry_after(e) or DEFAULT_RETRY_AFTER)
+                    raise
+
+    async def _stream(self, params: Dict) -> str:
+        """Stream a single message request and return the response text"""
+        chunks = []
+        async with self.client.messages.stream(**params) as stream:
+            async for text in stream.text_stream:
+                chunks.append(text)
+            self._check_final(await stream.get_final_message(), params["max_tokens"])
+        return "".join(chunks)
+
+    async def _create(self, prompt: str, system: Optional[List[Dict]] = None,
+                      max_tokens: Optional[int] = None) -> str:
+        """Send a single message request and return the response text"""
+        params = self._params(prompt, system, max_tokens)
+        try:
+            return await self._call(self._stream, params)
+        except TruncatedResponseError as e:
+            # Section caps are sized to typical output; give an unusually long one a second chance
+            params["max_tokens"] *= 2
+            logger.warning(f"{e}; retrying with max_tokens={params['max_tokens']}")
+            return await self._call(self._stream, params)
+
+    def _log_usage(self, response):
+        """Log token usage, including prompt cache hits"""
+        usage = response.usage
+        logger.debug(f"Claude usage: input={usage.input_tokens} output={usage.output_tokens} "
+                     f"cache_read={usage.cache_read_input_tokens} cache_write={usage.cache_creation_input_tokens}")
+
+    def _check_final(self, response, max_tokens: int):
+        """Log usage of a finished response and reject it if it was cut off at max_tokens"""
+        self._log_usage(response)
+        if response.stop_reason == "max_tokens":
+            raise TruncatedResponseError(f"response truncated at max_tokens={max_tokens}")
+
+    async def analyze_vm(self, vm_data: Dict, cluster_json: Optional[str] = None) -> Dict:
+        """
+        Analyze a single VM/LXC and generate comprehensive documentation and templates
+        """
+        vm_config = config_json(vm_data)
+        prompt = analysis_prompt(vm_data, vm_config)
+
+        try:
+            return {"analysis": await self._create(
+                prompt, build_system(cluster_json), self.section_max_tokens["analysis"]
+            )}
+        except Exception as e:
+            logger.error(f"Error analyzing VM {vm_data['vm_id']}: {e}")
+            return {"analysis": ERROR_MESSAGES["analysis"].format(e)}
+
+    async def security_review(self, vm_data: Dict, cluster_json: Optional[str] = None) -> Dict:
+        """Generate security review for a VM/LXC"""
+        vm_config = config_json(vm_data)
+        prompt = security_review_prompt(vm_data, vm_config)
+
+        try:
+            return {"security_review": await self._create(
+                prompt, build_system(cluster_json), self.section_max_tokens["security_review"]
+            )}
+        except Exception as e:
+            logger.error(f"Error in security review for {vm_data['vm_id']}: {e}")
+            return {"security_review": ERROR_MESSAGES["security_review"].format(e)}
+
+    async def optimization_recommendations(self, vm_data: Dict, cluster_json: Optional[str] = None) -> Dict:
+        """Generate optimization recommendations"""
+        vm_config = config_json(vm_data)
+        prompt = optimization_prompt(vm_data, vm_config)
+
+        try:
+            return {"optimization_recommendations": await self._create(
+                prompt, build_system(cluster_json), self.section_max_tokens["optimization_recommendations"]
+            )}
+        except Exception as e:
+            logger.error(f"Error generating optimizations for {vm_data['vm_id']}: {e}")
+            return {"optimization_recommendations": ERROR_MESSAGES["optimization_recommendations"].format(e)}
+
+    async def generate_terraform(self, vm_data: Dict, cluster_json: Optional[str] = None) -> Dict:
+        """Generate Terraform template for VM/LXC"""
+        vm_config = config_json(vm_data)
+        prompt = terraform_prompt(vm_data, vm_config)
+
+        try:
+            return {"terraform_template": await self._create(
+                prompt, build_system(cluster_json), self.section_max_tokens["terraform_template"]
+            )}
+        except Exception as e:
+            logger.error(f"Error generating Terraform for {vm_data['vm_id']}: {e}")
+            return {"terraform_template": ERROR_MESSAGES["terraform_template"].format(e)}
+
+    async def generate_ansible(self, vm_data: Dict, cluster_json: Optional[str] = None) -> Dict:
+        """Generate Ansible playbook for VM/LXC"""
+        vm_config = config_json(vm_data)
+        prompt = ansible_prompt(vm_data, vm_config)
+
+        try:
+            return {"ansible_playbook": await self._create(
+                prompt, build_system(cluster_json), self.section_max_tokens["ansible_playbook"]
+            )}
+        except Exception as e:
+            logger.error(f"Error generating Ansible for {vm_data['vm_id']}: {e}")
+            return {"ansible_playbook": ERROR_MESSAGES["ansible_playbook"].format(e)}
+
+    def _one_shot_max_tokens(self, sections: List[str]) -> int:
+        """A one-shot response holds every section, so its cap is the sum of theirs"""
+        return sum(self.section_max_tokens[section] for section in sections)
+
+    async def analyze_one_shot(self, vm_data: Dict, cluster_json: Optional[str] = None,
+                               flags: Optional[Dict[str, bool]] = None) -> Dict:
+        """Generate every enabled section for a VM/LXC with a single request"""
+        sections = enabled_sections(flags or {})
+        vm_config = config_json(vm_data)
+        prompt = one_shot_prompt(vm_data, vm_config, sections)
+        params = self._params(prompt, build_system(cluster_json), max_tokens=self._one_shot_max_tokens(sections))
+
+        try:
+            results, unfinished = await self._call(self._stream_sections, params, sections)
+        except Exception as e:
+            logger.error(f"Error in one-shot analysis for {vm_data['vm_id']}: {e}")
+            return {section: ERROR_MESSAGES[section].format(e) for section in sections}
+
+        # Sections completed before the response hit max_tokens are kept; the rest are requested on their own
+        if unfinished:
+            logger.warning(f"One-shot analysis for {vm_data['vm_id']} truncated at max_tokens={params['max_tokens']}; "
+                           f"requesting {', '.join(unfinished)} separately")
+            results.update(await self._request_sections(vm_data, cluster_json, unfinished))
+        return results
+
+    async def _stream_sections(self, params: Dict, sections: List[str]) -> Tuple[Dict, List[str]]:
+        """
+        Stream a one-shot request, splitting sections out as text arrives rather than at the end.
+        Also returns the sections left unfinished when the response was cut off at max_tokens.
+        """
+        parser = SectionStreamParser(sections)
+        async with self.client.messages.stream(**params) as stream:
+            async for text in stream.text_stream:
+                parser.feed(text)
+            response = await stream.get_final_message()
+            self._log_usage(response)
+
+        results = parser.close()
+        if response.stop_reason != "max_tokens":
+            return results, []
+        return results, [section for section in sections if section not in parser.finished]
+
+    async def _request_sections(self, vm_data: Dict, cluster_json: Optional[str], sections: List[str]) -> Dict:
+        """Generate the given sections with one direct request each, one at a time"""
+        methods = {
+            "analysis": self.analyze_vm,
+            "security_review": self.security_review,
+            "optimization_recommendations": self.optimization_recommendations,
+            "terraform_template": self.generate_terraform,
+            "ansible_playbook": self.generate_ansible,
+        }
+        # Sequential like analyze_complete, so a VM never has more than one request in flight
+        results = {}
+        for section in sections:
+            results.update(await methods[section](vm_data, cluster_json))
+        return results
+
+    async def submit_batch(self, vms: List[Dict], cluster_json: Optional[str] = None,
+                           flags: Optional[Dict[str, bool]] = None) -> Dict[str, Dict]:
+        """
+        Analyze many VMs/LXCs through the Message Batches API.
+        Every enabled section of every VM becomes one batch entry; results are
+        returned as {vm_id: {section: text}}.
+        """
+        sections = enabled_sections(flags or {})
+        system = build_system(cluster_json)
+
+        requests = []
+        for vm_data in vms:
+            vm_config = config_json(vm_data)
+            # custom_id only allows [a-zA-Z0-9_-], so ":" can't be used as separator
+            if self.one_shot:
+                prompt = one_shot_prompt(vm_data, vm_config, sections)
+                requests.append({
+                    "custom_id": f"{vm_data['vm_id']}-one_shot",
+                    "params": self._params(prompt, system, max_tokens=self._one_shot_max_tokens(sections))
+                })
+                continue
+
+            for section in sections:
+                prompt = build_prompt(section, vm_data, vm_config)
+                requests.append({
+                    "custom_id": f"{vm_data['vm_id']}-{section}",
+                    "params": self._params(prompt, system, self.section_max_tokens[section])
+                })
+
+        results = {vm_data["vm_id"]: {} for vm_data in vms}
+        # Sections cut off at max_tokens, per VM, to be retried as direct requests
+        truncated: Dict[str, List[str]] = {}
+        for chunk in batch_chunks(requests):
+            batch = await self._call(self.client.messages.batches.create, requests=chunk)
+            logger.info(f"Submitted message batch {batch.id} ({len(chunk)} requests)")
+
+            await self._wait_for_batch(batch.id)
+
+            for entry in await self._call(self._batch_results, batch.id):
+                vm_id, section = entry.custom_id.rsplit("-", 1)
+                entry_sections = sections if section == "one_shot" else [section]
+                succeeded = entry.result.type == "succeeded"
+                if succeeded and entry.result.message.content:
+                    text = entry.result.message.content[0].text
+                    if section == "one_shot":
+                        parser = SectionStreamParser(sections)
+                        parser.feed(text)
+                        results[vm_id].update(parser.close())
+                        unfinished = [s for s in sections if s not in parser.finished]
+                    else:
+                        results[vm_id][section] = text
+                        unfinished = [section]
+
+                    if entry.result.message.stop_reason == "max_tokens":
+                        logger.warning(f"Batch entry {entry.custom_id} truncated at max_tokens; "
+                                       f"requesting {', '.join(unfinished)} directly")
+                        truncated.setdefault(vm_id, []).extend(unfinished)
+                else:
+                    if succeeded:
+                        reason = "empty response"
+                    elif entry.result.type == "errored":
+                        reason = entry.result.error.error.message
+                    else:
+                        reason = f"request {entry.result.type}"
+                    logger.error(f"Batch entry {entry.custom_id} failed: {reason}")
+                    for failed in entry_sections:
+                        results[vm_id][failed] = ERROR_MESSAGES[failed].format(reason)
+
+        if truncated:
+            vms_by_id = {vm_data["vm_id"]: vm_data for vm_data in vms}
+            retried = await asyncio.gather(*(
+                self._request_sections(vms_by_id[vm_id], cluster_json, unfinished)
+                for vm_id, unfinished in truncated.items()
+            ))
+            for vm_id, sections_done in zip(truncated, retried):
+                results[vm_id].update(sections_done)
+
+        return results
+
+    async def _batch_results(self, batch_id: str) -> List:
+        """Download every result of an ended batch, so a failed download can be retried as a whole"""
+        return [entry async for entry in await self.client.messages.batches.results(batch_id)]
+
+    async def _wait_for_batch(self, batch_id: str):
+        """Poll a message batch with exponential backoff until processing has ended"""
+        delay = self.batch_poll_interval
+        while True:
+            batch = await self._call(self.client.messages.batches.retrieve, batch_id)
+            if batch.processing_status == "ended":
+                counts = batch.request_counts
+                logger.info(f"Message batch {batch_id} ended: {counts.succeeded} succeeded, "
+                            f"{counts.errored} errored, {counts.expired} expired")
+                return batch
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.batch_poll_max_interval)
+
+    async def generate_infrastructure_summary(self, all_analyses: list, cluster_info: Dict) -> str:
+        """Generate comprehensive infrastructure summary report"""
+        summary_data = {
+            "total_resources": len(all_analyses),
+            "vms": len([a for a in all_analyses if a.get("vm_type") == "qemu"]),
+            "lxcs": len([a for a in all_analyses if a.get("vm_type") == "lxc"]),
+            "nodes": cluster_info.get("nodes", [])
+        }
+
+        prompt = SUMMARY_TMPL.format(
+            total_resources=summary_data["total_resources"],
+            vms=summary_data["vms"],
+            lxcs=summary_data["lxcs"],
+            nodes=", ".join(summary_data["nodes"])
+        )
+
+        try:
+            return await self._create(prompt)
         except Exception as e:
             logger.error(f"Error generating infrastructure summary: {e}")
             return f"Error generating summary: {str(e)}"
 
-    async def analyze_complete(self, vm_data: Dict, cluster_context: Optional[Dict] = None,
+    async def analyze_complete(self, vm_data: Dict, cluster_json: Optional[str] = None,
                                include_security: bool = True, include_optimization: bool = True,
                                include_terraform: bool = True, include_ansible: bool = True) -> Dict:
         """
         Perform complete analysis of a VM/LXC including all optional components
         """
+        if self.one_shot:
+            return await self.analyze_one_shot(vm_data, cluster_json, flags={
+                "security_review": include_security,
+                "optimization_recommendations": include_optimization,
+                "terraform_template": include_terraform,
+                "ansible_playbook": include_ansible
+            })
+
         results = {}
 
         # Base analysis (always included)
-        analysis_result = await self.analyze_vm(vm_data, cluster_context)
+        analysis_result = await self.analyze_vm(vm_data, cluster_json)
         results.update(analysis_result)
 
         # Optional analyses
         if include_security:
-            security_result = await self.security_review(vm_data)
+            security_result = await self.security_review(vm_data, cluster_json)
             results.update(security_result)
 
         if include_optimization:
-            optimization_result = await self.optimization_recommendations(vm_data)
+            optimization_result = await self.optimization_recommendations(vm_data, cluster_json)
             results.update(optimization_result)
 
         if include_terraform:
-            terraform_result = await self.generate_terraform(vm_data)
+            terraform_result = await self.generate_terraform(vm_data, cluster_json)
             results.update(terraform_result)
 
         if include_ansible:
-            ansible_result = await self.generate_ansible(vm_data)
+            ansible_result = await self.generate_ansible(vm_data, cluster_json)
             results.update(ansible_result)
 
         return results
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import List, Optional
 
 
 class Settings(BaseSettings):
@@ -12,25 +12,51 @@ class Settings(BaseSettings):
     proxmox_token_name: Optional[str] = None
     proxmox_token_value: Optional[str] = None
     proxmox_verify_ssl: bool = False
+    proxmox_pool_size: int = 32  # Keep-alive connections to the Proxmox API
+    cache_ttl: float = 30.0  # Seconds to reuse Proxmox node, guest and config responses
 
     # Claude API Configuration
     anthropic_api_key: str
     claude_model: str = "claude-sonnet-4-20250514"
-    claude_max_tokens: int = 8000
+    claude_max_tokens: int = 8000  # Infrastructure summary
+    # Per-section output caps
+    claude_max_tokens_analysis: int = 1500
+    claude_max_tokens_security: int = 2500
+    claude_max_tokens_optimization: int = 2500
+    claude_max_tokens_terraform: int = 4000
+    claude_max_tokens_ansible: int = 4000
+    claude_max_connections: int = 64  # Pooled keep-alive connections to the Claude API
 
     # Application Configuration
     app_host: str = "0.0.0.0"
     app_port: int = 8000
+    workers: int = 1  # uvicorn worker processes; job state and limits are per process
+    # Origins allowed to call the API from a browser; the bundled frontend is same-origin
+    cors_origins: List[str] = ["http://localhost:8000", "http://127.0.0.1:8000"]
     database_url: str = "sqlite:///./proxmox_batch.db"
     output_dir: str = "./output"
+    thread_pool_size: int = 32  # Threads for blocking Proxmox calls and file I/O
+    use_uringcore: bool = False  # Run on the uringcore event loop instead of uvloop (pip install uringcore)
 
     # Analysis Configuration
-    batch_size: int = 5  # Process this many VMs/LXCs at a time
+    max_concurrency: int = 5  # Analyze at most this many VMs/LXCs at a time
+    batch_size: int = 64  # Save results and record job progress in groups of up to this many
     enable_terraform: bool = True
     enable_ansible: bool = True
     enable_security_review: bool = True
     enable_optimization: bool = True
 
+    # Re-run Claude even for VMs/LXCs whose analysis is cached from an earlier run
+    force_reanalyze: bool = False
+
+    # Message Batches API (half price, results arrive asynchronously)
+    use_batch_api: bool = True
+    batch_poll_interval: float = 5.0  # Initial seconds between batch status polls
+    batch_poll_max_interval: float = 60.0
+
+    # Request all enabled sections for a VM in one call instead of one call per section
+    one_shot: bool = False
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
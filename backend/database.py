@@ -1,18 +1,51 @@
 import aiosqlite
-import json
+import asyncio
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import AsyncIterator, List, Dict, Optional
 from pathlib import Path
 
+from serialization import dumps
+
+
+# Rows pulled from SQLite per round trip when streaming results
+FETCH_SIZE = 256
+
+VM_ANALYSIS_INSERT = """
+    INSERT INTO vm_analysis (
+        batch_job_id, vm_id, vm_name, vm_type, node, config,
+        analysis, security_review, optimization_recommendations,
+        terraform_template, ansible_playbook, analyzed_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+ANALYSIS_CACHE_INSERT = """
+    INSERT OR REPLACE INTO analysis_cache (
+        config_hash, analyzer_version, analysis, security_review, optimization_recommendations,
+        terraform_template, ansible_playbook, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# SQLite caps the number of bound parameters in one statement
+CACHE_LOOKUP_CHUNK = 500
+
 
 class Database:
     def __init__(self, db_path: str = "proxmox_batch.db"):
         self.db_path = db_path
+        self._conn: Optional[aiosqlite.Connection] = None
+        # aiosqlite runs every statement on one thread; the lock keeps write transactions from interleaving
+        self._write_lock = asyncio.Lock()
 
     async def init_db(self):
-        """Initialize database with required tables"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
+        """Open the shared connection and initialize database with required tables"""
+        self._conn = await aiosqlite.connect(self.db_path)
+        self._conn.row_factory = aiosqlite.Row
+        await self._conn.execute("PRAGMA journal_mode=WAL")
+        await self._conn.execute("PRAGMA synchronous=NORMAL")
+        await self._conn.execute("PRAGMA temp_store=MEMORY")
+
+        async with self._write_lock:
+            await self._conn.execute("""
                 CREATE TABLE IF NOT EXISTS batch_jobs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     started_at TIMESTAMP,
@@ -24,7 +57,7 @@ class Database:
                 )
             """)
 
-            await db.execute("""
+            await self._conn.execute("""
                 CREATE TABLE IF NOT EXISTS vm_analysis (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     batch_job_id INTEGER,
@@ -43,7 +76,7 @@ class Database:
                 )
             """)
 
-            await db.execute("""
+            await self._conn.execute("""
                 CREATE TABLE IF NOT EXISTS infrastructure_reports (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     batch_job_id INTEGER,
@@ -54,103 +87,213 @@ class Database:
                 )
             """)
 
-            await db.commit()
+            # Outputs of earlier runs, reused for VMs/LXCs whose definition is unchanged
+            await self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    config_hash TEXT PRIMARY KEY,
+                    analyzer_version TEXT,
+                    analysis TEXT,
+                    security_review TEXT,
+                    optimization_recommendations TEXT,
+                    terraform_template TEXT,
+                    ansible_playbook TEXT,
+                    created_at TIMESTAMP
+                )
+            """)
+
+            # Job lookups and the job list would otherwise scan whole tables
+            # Also serves per-VM lookups; supersedes the single-column index on batch_job_id
+            await self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_vm_analysis_job_vm ON vm_analysis(batch_job_id, vm_id)"
+            )
+            await self._conn.execute("DROP INDEX IF EXISTS idx_vm_analysis_job")
+            await self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_reports_job ON infrastructure_reports(batch_job_id)"
+            )
+            await self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_batch_jobs_started ON batch_jobs(started_at DESC)"
+            )
+
+            await self._conn.commit()
 
     async def create_batch_job(self, total_vms: int) -> int:
         """Create a new batch job and return its ID"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
+        async with self._write_lock:
+            cursor = await self._conn.execute(
                 "INSERT INTO batch_jobs (started_at, status, total_vms, processed_vms) VALUES (?, ?, ?, ?)",
                 (datetime.now().isoformat(), "running", total_vms, 0)
             )
-            await db.commit()
+            await self._conn.commit()
             return cursor.lastrowid
 
     async def update_batch_job(self, job_id: int, processed: int, status: str = "running", error: str = None):
         """Update batch job progress"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write_lock:
             if status == "completed":
-                await db.execute(
+                await self._conn.execute(
                     "UPDATE batch_jobs SET processed_vms = ?, status = ?, completed_at = ? WHERE id = ?",
                     (processed, status, datetime.now().isoformat(), job_id)
                 )
             else:
-                await db.execute(
+                await self._conn.execute(
                     "UPDATE batch_jobs SET processed_vms = ?, status = ?, error_message = ? WHERE id = ?",
                     (processed, status, error, job_id)
                 )
-            await db.commit()
+            await self._conn.commit()
+
+    async def update_job_status(self, job_id: int, status: str, error_message: str = None):
+        """Set a batch job's status, recording the finish time once it is no longer running"""
+        async with self._write_lock:
+            await self._conn.execute(
+                "UPDATE batch_jobs SET status = ?, error_message = ?, completed_at = ? WHERE id = ?",
+                (status, error_message, None if status == "running" else datetime.now().isoformat(), job_id)
+            )
+            await self._conn.commit()
 
     async def save_vm_analysis(self, batch_job_id: int, vm_data: Dict):
         """Save VM analysis results"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                INSERT INTO vm_analysis (
-                    batch_job_id, vm_id, vm_name, vm_type, node, config,
-                    analysis, security_review, optimization_recommendations,
-                    terraform_template, ansible_playbook, analyzed_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                batch_job_id,
-                vm_data["vm_id"],
-                vm_data["vm_name"],
-                vm_data["vm_type"],
-                vm_data["node"],
-                json.dumps(vm_data["config"]),
-                vm_data.get("analysis"),
-                vm_data.get("security_review"),
-                vm_data.get("optimization_recommendations"),
-                vm_data.get("terraform_template"),
-                vm_data.get("ansible_playbook"),
-                datetime.now().isoformat()
-            ))
-            await db.commit()
+        async with self._write_lock:
+            await self._conn.execute(VM_ANALYSIS_INSERT, self._vm_analysis_row(batch_job_id, vm_data))
+            await self._conn.commit()
+
+    async def save_vm_analyses_bulk(self, batch_job_id: int, rows: List[Dict]):
+        """Save many VM analysis results in a single transaction"""
+        if not rows:
+            return
+
+        async with self._write_lock:
+            await self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                await self._conn.executemany(
+                    VM_ANALYSIS_INSERT,
+                    [self._vm_analysis_row(batch_job_id, vm_data) for vm_data in rows]
+                )
+                await self._conn.commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+
+    @staticmethod
+    def _vm_analysis_row(batch_job_id: int, vm_data: Dict) -> tuple:
+        """Parameters for VM_ANALYSIS_INSERT"""
+        return (
+            batch_job_id,
+            vm_data["vm_id"],
+            vm_data["vm_name"],
+            vm_data["vm_type"],
+            vm_data["node"],
+            dumps(vm_data["config"]),
+            vm_data.get("analysis"),
+            vm_data.get("security_review"),
+            vm_data.get("optimization_recommendations"),
+            vm_data.get("terraform_template"),
+            vm_data.get("ansible_playbook"),
+            datetime.now().isoformat()
+        )
 
     async def save_infrastructure_report(self, batch_job_id: int, report_type: str, content: str):
         """Save infrastructure report"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
+        async with self._write_lock:
+            await self._conn.execute("""
                 INSERT INTO infrastructure_reports (batch_job_id, report_type, content, created_at)
                 VALUES (?, ?, ?, ?)
             """, (batch_job_id, report_type, content, datetime.now().isoformat()))
-            await db.commit()
+            await self._conn.commit()
 
     async def get_batch_job(self, job_id: int) -> Optional[Dict]:
         """Get batch job details"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM batch_jobs WHERE id = ?", (job_id,)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    return dict(row)
-                return None
+        async with self._conn.execute("SELECT * FROM batch_jobs WHERE id = ?", (job_id,)) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return dict(row)
+            return None
 
     async def get_all_batch_jobs(self) -> List[Dict]:
         """Get all batch jobs"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM batch_jobs ORDER BY started_at DESC") as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+        return [row async for row in self._iter_rows("SELECT * FROM batch_jobs ORDER BY started_at DESC")]
+
+    async def _iter_rows(self, sql: str, params: tuple = ()) -> AsyncIterator[Dict]:
+        """Stream query results as dicts, fetching FETCH_SIZE rows at a time"""
+        async with self._conn.execute(sql, params) as cursor:
+            cursor.arraysize = FETCH_SIZE
+            # Column names are the same for every row, so look them up once
+            columns = [col[0] for col in cursor.description]
+            while True:
+                rows = await cursor.fetchmany()
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(zip(columns, row))
+
+    def iter_vm_analyses(self, batch_job_id: int) -> AsyncIterator[Dict]:
+        """Stream the VM analyses for a batch job without loading them all at once"""
+        return self._iter_rows(
+            "SELECT * FROM vm_analysis WHERE batch_job_id = ?",
+            (batch_job_id,)
+        )
 
     async def get_vm_analyses(self, batch_job_id: int) -> List[Dict]:
         """Get all VM analyses for a batch job"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                "SELECT * FROM vm_analysis WHERE batch_job_id = ?",
-                (batch_job_id,)
-            ) as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+        return [row async for row in self.iter_vm_analyses(batch_job_id)]
+
+    async def get_vm_analysis(self, batch_job_id: int, vm_id: str) -> Optional[Dict]:
+        """Get the analysis of one VM/LXC in a batch job"""
+        async with self._conn.execute(
+            "SELECT * FROM vm_analysis WHERE batch_job_id = ? AND vm_id = ? LIMIT 1",
+            (batch_job_id, vm_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+            return dict(row) if row else None
 
     async def get_infrastructure_reports(self, batch_job_id: int) -> List[Dict]:
         """Get all infrastructure reports for a batch job"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                "SELECT * FROM infrastructure_reports WHERE batch_job_id = ?",
-                (batch_job_id,)
-            ) as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+        return [row async for row in self._iter_rows(
+            "SELECT * FROM infrastructure_reports WHERE batch_job_id = ?",
+            (batch_job_id,)
+        )]
+
+    async def get_cached_analyses(self, config_hashes: List[str], analyzer_version: str) -> Dict[str, Dict]:
+        """Cached analyses for the given hashes produced by this analyzer version, keyed by hash"""
+        cached = {}
+        for start in range(0, len(config_hashes), CACHE_LOOKUP_CHUNK):
+            chunk = config_hashes[start:start + CACHE_LOOKUP_CHUNK]
+            placeholders = ", ".join("?" * len(chunk))
+            async for row in self._iter_rows(
+                f"SELECT * FROM analysis_cache WHERE analyzer_version = ? AND config_hash IN ({placeholders})",
+                (analyzer_version, *chunk)
+            ):
+                cached[row["config_hash"]] = row
+        return cached
+
+    async def save_cached_analyses(self, analyzer_version: str, results: Dict[str, Dict]):
+        """Store analysis outputs keyed by config hash, replacing older entries"""
+        if not results:
+            return
+
+        now = datetime.now().isoformat()
+        async with self._write_lock:
+            await self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                await self._conn.executemany(ANALYSIS_CACHE_INSERT, [
+                    (
+                        config_hash,
+                        analyzer_version,
+                        result.get("analysis"),
+                        result.get("security_review"),
+                        result.get("optimization_recommendations"),
+                        result.get("terraform_template"),
+                        result.get("ansible_playbook"),
+                        now
+                    )
+                    for config_hash, result in results.items()
+                ])
+                await self._conn.commit()
+            except Exception:
+                await self._conn.rollback()
+                raise
+
+    async def close(self):
+        """Close the shared connection"""
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
@@ -0,0 +1,39 @@
+import asyncio
+from collections import defaultdict
+from typing import Dict, Set
+
+
+class JobEventBroker:
+    """
+    Fans job state updates out to the event stream subscribers in this process.
+
+    Every update is a full snapshot of the job, so each subscriber only needs the
+    latest one: its queue holds a single state and a newer update replaces it.
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[int, Set[asyncio.Queue]] = defaultdict(set)
+
+    def has_subscribers(self, job_id: int) -> bool:
+        return bool(self._subscribers.get(job_id))
+
+    def subscribe(self, job_id: int) -> asyncio.Queue:
+        """Register a subscriber for a job and return the queue its updates arrive on"""
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers[job_id].add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: int, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(job_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[job_id]
+
+    def publish(self, job_id: int, state: Dict):
+        """Hand a job's latest state to every subscriber, replacing any state not yet read"""
+        for queue in self._subscribers.get(job_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(state)
@@ -1,18 +1,25 @@
 from fastapi import FastAPI, BackgroundTasks, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 import logging
+import time
 from pathlib import Path
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import anyio
 
 from config import settings
 from database import Database
 from proxmox_client import ProxmoxClient
 from claude_analyzer import ClaudeAnalyzer
 from batch_processor import BatchProcessor
+from archive import is_up_to_date, iter_zip, iter_zip_saved
+from static_files import CachingStaticFiles
+from job_events import JobEventBroker
+from serialization import dumps
 
 # Configure logging
 logging.basicConfig(
@@ -25,16 +32,17 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Proxmox Batch Processor",
     description="Batch analyze and document your entire Proxmox infrastructure using Claude AI",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=settings.cors_origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
 )
 
 # Initialize components
@@ -43,8 +51,17 @@ proxmox_client = None
 claude_analyzer = None
 batch_processor = None
 
-# Track running jobs
-running_jobs = {}
+# Encoded status responses of running jobs, so clients polling together share one
+# database read per STATUS_CACHE_TTL: {job_id: (cached_at, body)}
+STATUS_CACHE_TTL = 1.0
+status_cache: Dict[int, Tuple[float, bytes]] = {}
+
+# Live job updates for /batch/jobs/{id}/events subscribers in this worker
+job_events = JobEventBroker()
+
+# Seconds an event stream waits for an update before checking the database itself;
+# covers jobs running in another worker, whose updates never reach this one
+EVENTS_FALLBACK_INTERVAL = 5.0
 
 
 class BatchJobRequest(BaseModel):
@@ -59,6 +76,11 @@ class BatchJobResponse(BaseModel):
     message: str
 
 
+class ConcurrencyRequest(BaseModel):
+    """Request to change the analysis concurrency limit"""
+    limit: int
+
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize database and clients on startup"""
@@ -66,6 +88,13 @@ async def startup_event():
 
     logger.info("Starting Proxmox Batch Processor")
 
+    # Blocking work runs in threads: proxmoxer calls and file I/O via asyncio.to_thread,
+    # streamed downloads via Starlette's anyio pool. Bound both to the same size.
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=settings.thread_pool_size, thread_name_prefix="blocking")
+    )
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.thread_pool_size
+
     # Initialize database
     await db.init_db()
     logger.info("Database initialized")
@@ -78,7 +107,9 @@ async def startup_event():
             password=settings.proxmox_password,
             token_name=settings.proxmox_token_name,
             token_value=settings.proxmox_token_value,
-            verify_ssl=settings.proxmox_verify_ssl
+            verify_ssl=settings.proxmox_verify_ssl,
+            cache_ttl=settings.cache_ttl,
+            pool_size=settings.proxmox_pool_size
         )
         logger.info(f"Connected to Proxmox at {settings.proxmox_host}")
     except Exception as e:
@@ -90,7 +121,18 @@ async def startup_event():
         claude_analyzer = ClaudeAnalyzer(
             api_key=settings.anthropic_api_key,
             model=settings.claude_model,
-            max_tokens=settings.claude_max_tokens
+            max_tokens=settings.claude_max_tokens,
+            batch_poll_interval=settings.batch_poll_interval,
+            batch_poll_max_interval=settings.batch_poll_max_interval,
+            one_shot=settings.one_shot,
+            max_connections=settings.claude_max_connections,
+            section_max_tokens={
+                "analysis": settings.claude_max_tokens_analysis,
+                "security_review": settings.claude_max_tokens_security,
+                "optimization_recommendations": settings.claude_max_tokens_optimization,
+                "terraform_template": settings.claude_max_tokens_terraform,
+                "ansible_playbook": settings.claude_max_tokens_ansible
+            }
         )
         logger.info("Claude analyzer initialized")
     except Exception as e:
@@ -99,12 +141,22 @@ async def startup_event():
 
     # Initialize batch processor
     batch_processor = BatchProcessor(proxmox_client, claude_analyzer, db)
+    batch_processor.on_progress = publish_job_state
     logger.info("Batch processor initialized")
 
     # Create output directory
     Path(settings.output_dir).mkdir(exist_ok=True)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release resources on shutdown"""
+    if claude_analyzer is not None:
+        await claude_analyzer.close()
+    await db.close()
+    logger.info("Database connection closed")
+
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -129,7 +181,7 @@ async def health_check():
 async def get_cluster_info():
     """Get Proxmox cluster information"""
     try:
-        cluster_info = proxmox_client.get_cluster_info()
+        cluster_info = await proxmox_client.get_cluster_info()
         return cluster_info
     except Exception as e:
         logger.error(f"Error fetching cluster info: {e}")
@@ -140,11 +192,13 @@ async def get_cluster_info():
 async def get_cluster_resources():
     """Get all VMs and LXCs in the cluster"""
     try:
-        resources = proxmox_client.get_all_resources()
+        # Listing only; configs are fetched when a job actually needs them
+        resources = await proxmox_client.list_cluster_resources()
+        counts = Counter(r["vm_type"] for r in resources)
         return {
             "total": len(resources),
-            "vms": len([r for r in resources if r["vm_type"] == "qemu"]),
-            "lxcs": len([r for r in resources if r["vm_type"] == "lxc"]),
+            "vms": counts["qemu"],
+            "lxcs": counts["lxc"],
             "resources": resources
         }
     except Exception as e:
@@ -152,17 +206,22 @@ async def get_cluster_resources():
         raise HTTPException(status_code=500, detail=str(e))
 
 
-async def run_batch_job_background(job_id: int):
+async def run_batch_job_background(job_id: int, resources: List[Dict]):
     """Background task to run batch analysis"""
     try:
-        running_jobs[job_id] = "running"
         logger.info(f"Starting background batch job {job_id}")
-        await batch_processor.run_full_analysis()
-        running_jobs[job_id] = "completed"
+        await batch_processor.run_full_analysis(job_id, resources=resources)
+        # The next job should see configs as they are now, not as cached before this one
+        proxmox_client.invalidate_cache()
         logger.info(f"Batch job {job_id} completed")
     except Exception as e:
         logger.error(f"Batch job {job_id} failed: {e}")
-        running_jobs[job_id] = "failed"
+        # Job state lives only in the database so every worker reports the same status
+        await db.update_job_status(job_id, "failed", error_message=str(e))
+    finally:
+        # Show the final state right away rather than after the cache expires
+        status_cache.pop(job_id, None)
+        await publish_job_state(job_id)
 
 
 @app.post("/batch/start", response_model=BatchJobResponse)
@@ -170,7 +229,7 @@ async def start_batch_job(background_tasks: BackgroundTasks):
     """Start a new batch analysis job"""
     try:
         # Get resource count
-        resources = proxmox_client.get_all_resources()
+        resources = await proxmox_client.get_all_resources()
         total_resources = len(resources)
 
         if total_resources == 0:
@@ -180,7 +239,7 @@ async def start_batch_job(background_tasks: BackgroundTasks):
         job_id = await db.create_batch_job(total_resources)
 
         # Start background processing
-        background_tasks.add_task(run_batch_job_background, job_id)
+        background_tasks.add_task(run_batch_job_background, job_id, resources)
 
         return BatchJobResponse(
             job_id=job_id,
@@ -212,17 +271,20 @@ async def get_batch_job(job_id: int):
         if not job:
             raise HTTPException(status_code=404, detail="Job not found")
 
-        # Get VM analyses
-        analyses = await db.get_vm_analyses(job_id)
-
         # Get reports
         reports = await db.get_infrastructure_reports(job_id)
 
-        return {
-            "job": job,
-            "analyses": analyses,
-            "reports": reports
-        }
+        # VM analyses are streamed into the response as they are read, so a large job
+        # is never held in memory as one list or one encoded body
+        async def body():
+            yield f'{{"job":{dumps(job)},"analyses":['
+            separator = ""
+            async for analysis in db.iter_vm_analyses(job_id):
+                yield separator + dumps(analysis)
+                separator = ","
+            yield f'],"reports":{dumps(reports)}}}'
+
+        return StreamingResponse(body(), media_type="application/json")
     except HTTPException:
         raise
     except Exception as e:
@@ -230,26 +292,52 @@ async def get_batch_job(job_id: int):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def job_state(job: Dict) -> Dict:
+    """Status and progress of a batch job, as reported by the status and events endpoints"""
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "progress": {
+            "processed": job["processed_vms"],
+            "total": job["total_vms"],
+            "percentage": round((job["processed_vms"] / job["total_vms"]) * 100, 2) if job["total_vms"] > 0 else 0
+        },
+        "started_at": job["started_at"],
+        "completed_at": job.get("completed_at"),
+        "error_message": job.get("error_message")
+    }
+
+
+async def publish_job_state(job_id: int):
+    """Push a job's current state to its event stream subscribers, if any"""
+    if not job_events.has_subscribers(job_id):
+        return
+    job = await db.get_batch_job(job_id)
+    if job:
+        job_events.publish(job_id, job_state(job))
+
+
 @app.get("/batch/jobs/{job_id}/status")
 async def get_job_status(job_id: int):
     """Get status of a batch job"""
+    cached = status_cache.get(job_id)
+    if cached and time.monotonic() - cached[0] < STATUS_CACHE_TTL:
+        return Response(cached[1], media_type="application/json")
+
     try:
         job = await db.get_batch_job(job_id)
         if not job:
             raise HTTPException(status_code=404, detail="Job not found")
 
-        return {
-            "job_id": job_id,
-            "status": job["status"],
-            "progress": {
-                "processed": job["processed_vms"],
-                "total": job["total_vms"],
-                "percentage": round((job["processed_vms"] / job["total_vms"]) * 100, 2) if job["total_vms"] > 0 else 0
-            },
-            "started_at": job["started_at"],
-            "completed_at": job.get("completed_at"),
-            "error_message": job.get("error_message")
-        }
+        # Polled every few seconds; returning the response directly skips FastAPI's encoding pass
+        response = ORJSONResponse(job_state(job))
+
+        # Finished jobs no longer change and are rarely polled again, so only running ones are kept
+        if job["status"] == "running":
+            status_cache[job_id] = (time.monotonic(), response.body)
+        else:
+            status_cache.pop(job_id, None)
+        return response
     except HTTPException:
         raise
     except Exception as e:
@@ -257,12 +345,46 @@ async def get_job_status(job_id: int):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/batch/jobs/{job_id}/events")
+async def stream_job_events(job_id: int):
+    """Stream a batch job's status as server-sent events until it completes or fails"""
+    job = await db.get_batch_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        state = job_state(job)
+        queue = job_events.subscribe(job_id)
+        try:
+            yield f"data: {dumps(state)}\n\n"
+            while state["status"] == "running":
+                try:
+                    update = await asyncio.wait_for(queue.get(), EVENTS_FALLBACK_INTERVAL)
+                except asyncio.TimeoutError:
+                    latest = await db.get_batch_job(job_id)
+                    update = job_state(latest) if latest else state
+
+                if update == state:
+                    # Keeps proxies from timing out the connection and detects disconnected clients
+                    yield ": keepalive\n\n"
+                    continue
+                state = update
+                yield f"data: {dumps(state)}\n\n"
+        finally:
+            job_events.unsubscribe(job_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.get("/batch/jobs/{job_id}/analyses/{vm_id}")
 async def get_vm_analysis(job_id: int, vm_id: str):
     """Get analysis for a specific VM in a batch job"""
     try:
-        analyses = await db.get_vm_analyses(job_id)
-        vm_analysis = next((a for a in analyses if a["vm_id"] == vm_id), None)
+        vm_analysis = await db.get_vm_analysis(job_id, vm_id)
 
         if not vm_analysis:
             raise HTTPException(status_code=404, detail="VM analysis not found")
@@ -284,20 +406,22 @@ async def download_job_outputs(job_id: int):
         if not output_dir.exists():
             raise HTTPException(status_code=404, detail="Job outputs not found")
 
-        # Create zip file
-        import shutil
+        zip_name = f"proxmox_batch_job_{job_id}.zip"
         zip_path = Path(settings.output_dir) / f"job_{job_id}.zip"
 
-        shutil.make_archive(
-            str(zip_path.with_suffix('')),
-            'zip',
-            str(output_dir)
-        )
+        # Outputs of an unfinished job are still being written, so only a completed job's zip is kept
+        job = await db.get_batch_job(job_id)
+        completed = job is not None and job["status"] == "completed"
+
+        # Reuse the zip saved by an earlier download unless outputs changed since
+        if completed and await asyncio.to_thread(is_up_to_date, zip_path, output_dir):
+            return FileResponse(path=str(zip_path), filename=zip_name, media_type="application/zip")
 
-        return FileResponse(
-            path=str(zip_path),
-            filename=f"proxmox_batch_job_{job_id}.zip",
-            media_type="application/zip"
+        # Compressed while it is sent; Starlette runs the sync generator in a worker thread
+        return StreamingResponse(
+            iter_zip_saved(output_dir, zip_path) if completed else iter_zip(output_dir),
+            media_type="application/zip",
+            headers={"Content-Disposition": f'attachment; filename="{zip_name}"'}
         )
 
     except HTTPException:
@@ -307,17 +431,56 @@ async def download_job_outputs(job_id: int):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/admin/concurrency")
+async def get_concurrency():
+    """Get the current analysis concurrency limit"""
+    return batch_processor.concurrency
+
+
+@app.post("/admin/concurrency")
+async def set_concurrency(request: ConcurrencyRequest):
+    """Change the analysis concurrency limit, including for running jobs"""
+    if settings.workers > 1:
+        # The limit lives in each worker process, so a request would only change one of them
+        raise HTTPException(
+            status_code=409,
+            detail="Concurrency can't be changed at runtime with multiple workers; set MAX_CONCURRENCY and restart"
+        )
+    if request.limit < 1:
+        raise HTTPException(status_code=400, detail="Concurrency limit must be at least 1")
+
+    await batch_processor.set_concurrency(request.limit)
+    return batch_processor.concurrency
+
+
 # Mount frontend static files at root
 frontend_path = Path(__file__).parent / "frontend"
 if frontend_path.exists():
-    app.mount("/", StaticFiles(directory=str(frontend_path), html=True), name="frontend")
+    app.mount("/", CachingStaticFiles(directory=str(frontend_path), html=True), name="frontend")
 
 
 if __name__ == "__main__":
     import uvicorn
+
+    loop = "uvloop"
+    if settings.use_uringcore and settings.workers > 1:
+        # Worker processes create their loop before importing this module, so the policy can't reach them
+        logger.warning("USE_URINGCORE only applies with a single worker; using uvloop")
+    elif settings.use_uringcore:
+        # io_uring based loop (Linux 5.11+); uvicorn then uses the policy as set here
+        try:
+            import uringcore
+            asyncio.set_event_loop_policy(uringcore.EventLoopPolicy())
+            loop = "none"
+        except ImportError:
+            logger.warning("USE_URINGCORE is set but uringcore is not installed; using uvloop")
+
     uvicorn.run(
         "main:app",
         host=settings.app_host,
         port=settings.app_port,
-        reload=False
+        reload=False,
+        workers=settings.workers,
+        loop=loop,
+        http="httptools"
     )
@@ -1,15 +1,26 @@
 from proxmoxer import ProxmoxAPI
-from typing import List, Dict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Any, Callable, List, Dict, Tuple
+import asyncio
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Name prefix for guests without one, also used in log messages
+GUEST_LABELS = {"qemu": "VM", "lxc": "LXC"}
+
 
 class ProxmoxClient:
     def __init__(self, host: str, user: str, password: str = None,
-                 token_name: str = None, token_value: str = None, verify_ssl: bool = False):
+                 token_name: str = None, token_value: str = None, verify_ssl: bool = False,
+                 cache_ttl: float = 30.0, pool_size: int = 32):
         """Initialize Proxmox API client"""
         self.host = host
+        # Node list, guest list and configs, keyed by API path: {key: (fetched_at, value)}
+        self.cache_ttl = cache_ttl
+        self._cache: Dict[Tuple, Tuple[float, Any]] = {}
 
         if token_name and token_value:
             # Use API token authentication
@@ -31,95 +42,124 @@ class ProxmoxClient:
         else:
             raise ValueError("Either password or token credentials must be provided")
 
-    def get_all_nodes(self) -> List[str]:
+        # proxmoxer shares one requests session for all calls; size its keep-alive pool for
+        # concurrent fetches and retry idempotent requests on gateway errors
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False)
+        )
+        self.proxmox._store["session"].mount("https://", adapter)
+
+    async def _cached(self, key: Tuple, fetch: Callable[[], Any]) -> Any:
+        """Return the cached value for key if still fresh, otherwise run the blocking fetch in a thread"""
+        entry = self._cache.get(key)
+        if entry and time.monotonic() - entry[0] < self.cache_ttl:
+            return entry[1]
+
+        value = await asyncio.to_thread(fetch)
+        self._cache[key] = (time.monotonic(), value)
+        return value
+
+    def invalidate_cache(self):
+        """Drop all cached responses so the next call refetches from Proxmox"""
+        self._cache.clear()
+
+    async def get_all_nodes(self) -> List[str]:
         """Get all nodes in the cluster"""
         try:
-            nodes = self.proxmox.nodes.get()
+            nodes = await self._cached(("nodes",), self.proxmox.nodes.get)
             return [node['node'] for node in nodes]
         except Exception as e:
             logger.error(f"Error fetching nodes: {e}")
             return []
 
-    def get_all_vms(self) -> List[Dict]:
+    async def list_cluster_resources(self, kind: str = "vm") -> List[Dict]:
+        """
+        List guests across the whole cluster with a single cluster/resources call.
+        Configs are not included; use fetch_configs for the guests that need them.
+        """
+        try:
+            entries = await self._cached(
+                ("cluster_resources", kind),
+                lambda: self.proxmox.cluster.resources.get(type=kind)
+            )
+        except Exception as e:
+            logger.error(f"Error fetching cluster resources: {e}")
+            return []
+
+        guests = [
+            {
+                "node": entry["node"],
+                "vm_id": str(entry["vmid"]),
+                "vm_name": entry.get("name", f"{GUEST_LABELS[entry['type']]}-{entry['vmid']}"),
+                "vm_type": entry["type"],
+                "status": entry.get("status", "unknown")
+            }
+            for entry in entries
+            if entry.get("type") in GUEST_LABELS
+        ]
+        # VMs before LXCs, then by node and ID, as the per-node listing used to return them
+        guests.sort(key=lambda g: (list(GUEST_LABELS).index(g["vm_type"]), g["node"], int(g["vm_id"])))
+        return guests
+
+    async def fetch_configs(self, pairs: List[Tuple[str, str, str]]) -> List[Dict]:
+        """Fetch configs for (node, vmid, kind) triples concurrently, in the same order"""
+        return await asyncio.gather(*(
+            self.get_vm_config(node, vmid) if kind == "qemu" else self.get_lxc_config(node, vmid)
+            for node, vmid, kind in pairs
+        ))
+
+    async def _get_guests(self, kinds: Tuple[str, ...]) -> List[Dict]:
+        """Guests of the given kinds ("qemu", "lxc") with their configs"""
+        guests = [g for g in await self.list_cluster_resources() if g["vm_type"] in kinds]
+        configs = await self.fetch_configs([(g["node"], g["vm_id"], g["vm_type"]) for g in guests])
+        for guest, config in zip(guests, configs):
+            guest["config"] = config
+        return guests
+
+    async def get_all_vms(self) -> List[Dict]:
         """Get all VMs (QEMU) from all nodes"""
-        all_vms = []
-        nodes = self.get_all_nodes()
-
-        for node in nodes:
-            try:
-                vms = self.proxmox.nodes(node).qemu.get()
-                for vm in vms:
-                    vm_detail = {
-                        "node": node,
-                        "vm_id": str(vm["vmid"]),
-                        "vm_name": vm.get("name", f"VM-{vm['vmid']}"),
-                        "vm_type": "qemu",
-                        "status": vm.get("status", "unknown"),
-                        "config": self.get_vm_config(node, vm["vmid"])
-                    }
-                    all_vms.append(vm_detail)
-            except Exception as e:
-                logger.error(f"Error fetching VMs from node {node}: {e}")
-
-        return all_vms
-
-    def get_all_lxcs(self) -> List[Dict]:
+        return await self._get_guests(("qemu",))
+
+    async def get_all_lxcs(self) -> List[Dict]:
         """Get all LXC containers from all nodes"""
-        all_lxcs = []
-        nodes = self.get_all_nodes()
-
-        for node in nodes:
-            try:
-                lxcs = self.proxmox.nodes(node).lxc.get()
-                for lxc in lxcs:
-                    lxc_detail = {
-                        "node": node,
-                        "vm_id": str(lxc["vmid"]),
-                        "vm_name": lxc.get("name", f"LXC-{lxc['vmid']}"),
-                        "vm_type": "lxc",
-                        "status": lxc.get("status", "unknown"),
-                        "config": self.get_lxc_config(node, lxc["vmid"])
-                    }
-                    all_lxcs.append(lxc_detail)
-            except Exception as e:
-                logger.error(f"Error fetching LXCs from node {node}: {e}")
-
-        return all_lxcs
-
-    def get_all_resources(self) -> List[Dict]:
+        return await self._get_guests(("lxc",))
+
+    async def get_all_resources(self) -> List[Dict]:
         """Get all VMs and LXCs from the entire cluster"""
-        vms = self.get_all_vms()
-        lxcs = self.get_all_lxcs()
-        return vms + lxcs
+        return await self._get_guests(("qemu", "lxc"))
 
-    def get_vm_config(self, node: str, vmid: int) -> Dict:
+    async def get_vm_config(self, node: str, vmid: int) -> Dict:
         """Get detailed configuration for a VM"""
         try:
-            config = self.proxmox.nodes(node).qemu(vmid).config.get()
-            return config
+            return await self._cached(("qemu", node, str(vmid)), self.proxmox.nodes(node).qemu(vmid).config.get)
         except Exception as e:
             logger.error(f"Error fetching VM config for {vmid} on {node}: {e}")
             return {}
 
-    def get_lxc_config(self, node: str, vmid: int) -> Dict:
+    async def get_lxc_config(self, node: str, vmid: int) -> Dict:
         """Get detailed configuration for an LXC container"""
         try:
-            config = self.proxmox.nodes(node).lxc(vmid).config.get()
-            return config
+            return await self._cached(("lxc", node, str(vmid)), self.proxmox.nodes(node).lxc(vmid).config.get)
         except Exception as e:
             logger.error(f"Error fetching LXC config for {vmid} on {node}: {e}")
             return {}
 
-    def get_cluster_info(self) -> Dict:
+    async def get_cluster_info(self) -> Dict:
         """Get overall cluster information"""
         try:
-            cluster_status = self.proxmox.cluster.status.get()
-            cluster_resources = self.proxmox.cluster.resources.get()
+            # Independent calls, so issue them together
+            cluster_status, cluster_resources, nodes = await asyncio.gather(
+                asyncio.to_thread(self.proxmox.cluster.status.get),
+                asyncio.to_thread(self.proxmox.cluster.resources.get),
+                self.get_all_nodes()
+            )
 
             return {
                 "status": cluster_status,
                 "resources": cluster_resources,
-                "nodes": self.get_all_nodes()
+                "nodes": nodes
             }
         except Exception as e:
             logger.error(f"Error fetching cluster info: {e}")
@@ -0,0 +1,16 @@
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+
+def dumps(obj, indent: bool = False, sort_keys: bool = False) -> str:
+    """
+    Serialize to a JSON string (two-space indent if requested), using orjson when installed.
+    With sort_keys the output is canonical, so equal objects serialize identically.
+    """
+    if orjson is not None:
+        option = (orjson.OPT_INDENT_2 if indent else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, option=option).decode()
+    return json.dumps(obj, indent=2 if indent else None, sort_keys=sort_keys)
@@ -0,0 +1,25 @@
+import os
+import re
+
+from fastapi.staticfiles import StaticFiles
+from starlette.responses import Response
+from starlette.types import Scope
+
+# Content-hashed asset names such as app.3f9c2b1d.js; their content never changes
+HASHED_ASSET_RE = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+
+
+class CachingStaticFiles(StaticFiles):
+    """
+    StaticFiles with explicit caching: hashed assets are cached for a year, everything
+    else is revalidated on each use via the ETag StaticFiles already sends.
+    """
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope,
+                      status_code: int = 200) -> Response:
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if HASHED_ASSET_RE.search(os.fspath(full_path)):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
@@ -3,7 +3,7 @@ const API_BASE = window.location.origin;
 
 // State
 let currentJobId = null;
-let pollingInterval = null;
+let jobEvents = null;
 
 // Initialize app
 document.addEventListener('DOMContentLoaded', () => {
@@ -117,8 +117,8 @@ async function startAnalysis() {
         document.getElementById('active-job-section').style.display = 'block';
         document.getElementById('current-job-id').textContent = data.job_id;
 
-        // Start polling for job status
-        startPolling(data.job_id);
+        // Follow job status as the server pushes it
+        watchJob(data.job_id);
 
         // Reload jobs list
         loadJobs();
@@ -130,39 +130,42 @@ async function startAnalysis() {
     }
 }
 
-// Poll job status
-function startPolling(jobId) {
-    if (pollingInterval) {
-        clearInterval(pollingInterval);
+// Follow job status via server-sent events
+function watchJob(jobId) {
+    if (jobEvents) {
+        jobEvents.close();
     }
 
-    pollingInterval = setInterval(async () => {
-        try {
-            const data = await apiCall(`/batch/jobs/${jobId}/status`);
-            updateProgress(data);
+    jobEvents = new EventSource(`${API_BASE}/batch/jobs/${jobId}/events`);
 
-            if (data.status === 'completed' || data.status === 'failed') {
-                clearInterval(pollingInterval);
-                pollingInterval = null;
+    jobEvents.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        updateProgress(data);
 
-                // Re-enable start button
-                const btn = document.getElementById('start-analysis-btn');
-                btn.disabled = false;
-                btn.textContent = 'Start Batch Analysis';
+        if (data.status === 'completed' || data.status === 'failed') {
+            jobEvents.close();
+            jobEvents = null;
 
-                // Reload jobs
-                loadJobs();
+            // Re-enable start button
+            const btn = document.getElementById('start-analysis-btn');
+            btn.disabled = false;
+            btn.textContent = 'Start Batch Analysis';
 
-                if (data.status === 'completed') {
-                    showNotification('Analysis completed successfully!', 'success');
-                } else {
-                    showNotification('Analysis failed', 'error');
-                }
+            // Reload jobs
+            loadJobs();
+
+            if (data.status === 'completed') {
+                showNotification('Analysis completed successfully!', 'success');
+            } else {
+                showNotification('Analysis failed', 'error');
             }
-        } catch (error) {
-            console.error('Failed to poll job status:', error);
         }
-    }, 2000); // Poll every 2 seconds
+    };
+
+    // EventSource reconnects by itself; the server resends the current state on reconnect
+    jobEvents.onerror = () => {
+        console.error('Job event stream interrupted, reconnecting');
+    };
 }
 
 // Update progress bar